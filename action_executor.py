@@ -0,0 +1,156 @@
+import os
+import sys
+import json
+import shutil
+import errno
+import threading
+import subprocess
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+
+
+class ActionExecutor:
+    def __init__(self, config):
+        """
+         @brief Initialize the executor. Files are removed, moved and linked in process, and only removals and moves that fail with a
+                permission error go through a privileged helper, started with sudo once per run on the first such action
+         @param config A config object that contains the configuration for the task
+        """
+        self._config = config
+        self._helper = None
+        # Plans are applied by a thread per device, which share the helper
+        self._helper_lock = threading.Lock()
+        self._dir_devices = dict()
+
+    def _get_dir_device(self, dir_path):
+        """
+         @brief Get the device of a directory. Results are cached per directory
+         @param dir_path Path of the directory
+         @return st_dev of the directory
+        """
+        if dir_path not in self._dir_devices:
+            self._dir_devices[dir_path] = os.stat(dir_path).st_dev
+        return self._dir_devices[dir_path]
+
+    def _is_cross_device(self, file_path, dest_path):
+        """
+         @brief Check whether a move crosses devices, in which case it has to copy the file instead of renaming it.
+         @param file_path Path of the file to move
+         @param dest_path Path to move the file to
+         @return True if the file and the destination directory are on different devices
+        """
+        return os.stat(file_path).st_dev != self._get_dir_device(os.path.dirname(dest_path) or ".")
+
+    def _get_free_dest_path(self, dest_path):
+        """
+         @brief Get a destination path that doesn't overwrite an existing file, by adding " (n)" before the extension.
+         @param dest_path Wanted destination path
+         @return dest_path, or the first free numbered variant of it
+        """
+        root, extension = os.path.splitext(dest_path)
+        number = 1
+        while os.path.lexists(dest_path):
+            dest_path = f"{root} ({number}){extension}"
+            number += 1
+        return dest_path
+
+    def remove(self, file_path):
+        """
+         @brief Remove a file. Raises OSError if it can't be removed
+         @param file_path Path of the file
+        """
+        try:
+            os.remove(file_path)
+        except PermissionError as e:
+            self._run_privileged({"action": "remove", "file_path": file_path}, e)
+
+    def move(self, file_path, dest_path):
+        """
+         @brief Move a file, renaming it on the same device and copying it across devices. Raises OSError if it can't be moved
+         @param file_path Path of the file
+         @param dest_path Path to move the file to, a free variant is used if a file already exists there
+         @return Path the file was moved to
+        """
+        dest_path = self._get_free_dest_path(dest_path)
+        try:
+            if self._is_cross_device(file_path, dest_path):
+                shutil.move(file_path, dest_path)
+            else:
+                os.rename(file_path, dest_path)
+        except PermissionError as e:
+            self._run_privileged({"action": "move", "file_path": file_path, "dest_path": dest_path}, e)
+        return dest_path
+
+    def link(self, file_path, keeper_path, dedup_mode):
+        """
+         @brief Replace a duplicate with a hardlink or a copy-on-write reflink of its keeper. The link is made under a
+                temporary name next to the duplicate and renamed over it, so the path never disappears. Raises OSError if
+                the link can't be made, e.g. across devices or on a file system without reflinks
+         @param file_path Path of the duplicate
+         @param keeper_path Path of the kept file with the same content
+         @param dedup_mode "hardlink" or "reflink"
+        """
+        dir_path, file_name = os.path.split(file_path)
+        temp_path = os.path.join(dir_path, f".{file_name}.dedup-{os.getpid()}")
+        try:
+            if dedup_mode == "hardlink":
+                os.link(keeper_path, temp_path)
+            else:
+                self._reflink(keeper_path, temp_path)
+                shutil.copystat(file_path, temp_path)
+            os.replace(temp_path, file_path)
+        except OSError:
+            if os.path.lexists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def _reflink(self, keeper_path, temp_path):
+        """
+         @brief Create a copy-on-write clone of a file with the FICLONE ioctl, supported by btrfs and XFS on Linux.
+         @param keeper_path Path of the file to clone
+         @param temp_path Path of the clone
+        """
+        if fcntl is None or not sys.platform.startswith("linux"):
+            raise OSError(errno.EOPNOTSUPP, "Reflinks are only supported on Linux")
+        with open(keeper_path, "rb") as source, open(temp_path, "xb") as clone:
+            fcntl.ioctl(clone.fileno(), FICLONE, source.fileno())
+
+    def _run_privileged(self, action, error):
+        """
+         @brief Run an action through the privileged helper. Raises the original error when USE_PRIVILEGED_HELPER is off,
+                sudo is not available or the process is already privileged, and OSError when the helper fails too
+         @param action Dictionary describing the action, see privileged_helper.run_action
+         @param error PermissionError of the in-process attempt
+        """
+        if not self._config.get("USE_PRIVILEGED_HELPER", True) or os.name == "nt" or os.geteuid() == 0:
+            raise error
+        with self._helper_lock:
+            if self._helper is None:
+                helper_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "privileged_helper.py")
+                try:
+                    self._helper = subprocess.Popen(["sudo", sys.executable, helper_path], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                                    text=True, encoding="utf-8")
+                except OSError:
+                    raise error
+            self._helper.stdin.write(json.dumps(action) + "\n")
+            self._helper.stdin.flush()
+            response = self._helper.stdout.readline()
+        if not response:
+            raise error
+        result = json.loads(response)
+        if not result["ok"]:
+            raise OSError(result["error"])
+
+    def close(self):
+        """
+         @brief Stop the privileged helper, if it was started.
+        """
+        if self._helper is not None:
+            self._helper.stdin.close()
+            self._helper.wait()
+            self._helper = None
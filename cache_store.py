@@ -0,0 +1,141 @@
+import time
+import sqlite3
+
+
+class CacheStore:
+    def __init__(self, db_path, is_writable, commit_rows, commit_seconds):
+        """
+         @brief Open the file index database. It is an SQLite database in WAL mode, looked up by file key, path and size
+                on demand instead of being loaded at startup, and committed in batches while the scan runs so a crashed
+                run loses at most one batch
+         @param db_path Path of the database file, or ":memory:" for an index that only lives for this run
+         @param is_writable Commit changes when True, roll them back on close otherwise
+         @param commit_rows Commit after this many changed rows
+         @param commit_seconds Commit when this many seconds passed since the last commit
+        """
+        self._is_writable = is_writable
+        self._commit_rows = commit_rows
+        self._commit_seconds = commit_seconds
+        self._pending_rows = 0
+        self._last_commit = time.monotonic()
+        self._connection = sqlite3.connect(db_path)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        # WAL commits with synchronous=NORMAL are durable across process crashes without an fsync per commit
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, file_key TEXT NOT NULL, size INTEGER NOT NULL, partial TEXT, hash TEXT)")
+        # Perceptual fingerprints of images were added after the first release of the table
+        if "fingerprint" not in [column[1] for column in self._connection.execute("PRAGMA table_info(files)")]:
+            self._connection.execute("ALTER TABLE files ADD COLUMN fingerprint TEXT")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS files_file_key ON files (file_key)")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS files_size ON files (size)")
+        # No query looks files up by hash, the index of earlier releases only slowed down every write
+        self._connection.execute("DROP INDEX IF EXISTS files_hash")
+        self._connection.commit()
+
+    def _changed(self, row_count=1):
+        """
+         @brief Count changed rows and commit once a batch is full or old enough.
+         @param row_count Number of rows changed
+        """
+        self._pending_rows += row_count
+        if self._pending_rows >= self._commit_rows or time.monotonic() - self._last_commit >= self._commit_seconds:
+            self.commit()
+
+    def commit(self):
+        """
+         @brief Commit the pending changes, if the store is writable.
+        """
+        if self._is_writable:
+            self._connection.commit()
+        self._pending_rows = 0
+        self._last_commit = time.monotonic()
+
+    def clear(self):
+        """
+         @brief Delete every row, for runs that must not read the index of previous runs.
+        """
+        self._connection.execute("DELETE FROM files")
+        self._changed()
+
+    def get_by_key(self, file_key):
+        """
+         @brief Get the row of a file by its key.
+         @param file_key Key of the file as built by FileManager._get_file_key
+         @return Dictionary with the path, partial hash, hash and fingerprint of the file, or None if not stored
+        """
+        row = self._connection.execute("SELECT path, partial, hash, fingerprint FROM files WHERE file_key = ? LIMIT 1", (file_key,)).fetchone()
+        if row is None:
+            return None
+        return {"path": row[0], "partial": row[1], "hash": row[2], "fingerprint": row[3]}
+
+    def get_by_path(self, path):
+        """
+         @brief Get the row of a path.
+         @param path Path of the file
+         @return Dictionary with the file key, partial hash and hash of the file, or None if not stored
+        """
+        row = self._connection.execute("SELECT file_key, partial, hash FROM files WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return None
+        return {"file_key": row[0], "partial": row[1], "hash": row[2]}
+
+    def get_by_size(self, size):
+        """
+         @brief Get the files of a given size.
+         @param size Size of the files in bytes
+         @return List of (path, file key) tuples
+        """
+        return self._connection.execute("SELECT path, file_key FROM files WHERE size = ?", (size,)).fetchall()
+
+    def iter_rows(self, batch_size=1000):
+        """
+         @brief Iterate over every row in rowid order, a batch at a time, so rows can be deleted while iterating.
+         @param batch_size Number of rows fetched at once
+         @return Iterator over (path, file key) tuples
+        """
+        last_rowid = 0
+        while True:
+            rows = self._connection.execute("SELECT rowid, path, file_key FROM files WHERE rowid > ? ORDER BY rowid LIMIT ?", (last_rowid, batch_size)).fetchall()
+            if not rows:
+                return
+            for rowid, path, file_key in rows:
+                yield path, file_key
+            last_rowid = rows[-1][0]
+
+    def set(self, file_key, path, size, partial=None, hash=None, fingerprint=None):
+        """
+         @brief Add or update the row of a path. Hashes that are not given keep their stored value, unless the file key changed
+         @param file_key Key of the file as built by FileManager._get_file_key
+         @param path Path of the file
+         @param size Size of the file in bytes
+         @param partial Partial hash of the file
+         @param hash Full hash of the file
+         @param fingerprint Perceptual fingerprint of the image
+        """
+        self._connection.execute(
+            "INSERT INTO files (path, file_key, size, partial, hash, fingerprint) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (path) DO UPDATE SET "
+            "partial = CASE WHEN file_key = excluded.file_key THEN coalesce(excluded.partial, partial) ELSE excluded.partial END, "
+            "hash = CASE WHEN file_key = excluded.file_key THEN coalesce(excluded.hash, hash) ELSE excluded.hash END, "
+            "fingerprint = CASE WHEN file_key = excluded.file_key THEN coalesce(excluded.fingerprint, fingerprint) ELSE excluded.fingerprint END, "
+            "file_key = excluded.file_key, size = excluded.size",
+            (path, file_key, size, partial, hash, fingerprint))
+        self._changed()
+
+    def remove_by_path(self, path):
+        """
+         @brief Remove the row of a path, if present.
+         @param path Path of the file
+        """
+        self._changed(self._connection.execute("DELETE FROM files WHERE path = ?", (path,)).rowcount)
+
+    def close(self):
+        """
+         @brief Commit the pending changes and close the database.
+        """
+        if self._is_writable:
+            self._connection.commit()
+        else:
+            self._connection.rollback()
+        self._connection.close()
@@ -0,0 +1,256 @@
+import json
+import mmap
+import heapq
+import logging
+import tempfile
+from array import array
+
+logger = logging.getLogger("file_manager")
+
+# Spilled runs are merged into one when there are more than this many, so a lookup searches few files
+MAX_SPILLED_RUNS = 8
+
+
+class CompactIndex:
+    def __init__(self, digest_size, memory_limit, spill_dir=None):
+        """
+         @brief Initialize the index. Sizes and values are kept in arrays('Q'), raw digests in one packed bytearray and
+                an open addressing table of row numbers finds them, about 48 bytes per 16-byte digest instead of well over 100 for a dict
+         @param digest_size Length of the raw digests in bytes
+         @param memory_limit Memory in bytes above which the in-memory rows are written to a sorted run on disk
+         @param spill_dir Directory of the spilled runs, the system temporary directory by default
+        """
+        self._digest_size = digest_size
+        # Spilled records are the digest and the big endian size, which sort like (digest, size), then the value
+        self._key_size = digest_size + 8
+        self._record_size = digest_size + 16
+        self._memory_limit = memory_limit
+        self._spill_dir = spill_dir
+        self._spilled_runs = list()
+        self._spilled_count = 0
+        self._clear_memory()
+
+    def _clear_memory(self):
+        """
+         @brief Drop the in-memory rows, after they are spilled to disk.
+        """
+        self._sizes = array("Q")
+        self._values = array("Q")
+        self._digests = bytearray()
+        self._slots = array("q", [-1]) * 1024
+
+    def __len__(self):
+        return len(self._sizes) + self._spilled_count
+
+    def get_memory_usage(self):
+        """
+         @brief Get the memory used by the in-memory rows and their lookup table.
+         @return Memory in bytes
+        """
+        return len(self._sizes) * 16 + len(self._digests) + len(self._slots) * 8
+
+    def _find_slot(self, slots, size, digest):
+        """
+         @brief Find the slot of a row in a lookup table with linear probing. Digests are uniformly distributed so their first bytes make a good slot hash
+         @param slots Lookup table of row numbers, -1 for empty slots. Its length is a power of two
+         @param size Size of the file in bytes
+         @param digest Raw digest of the file
+         @return Tuple of (slot, True if the row is in the slot or False if the slot is empty)
+        """
+        mask = len(slots) - 1
+        slot = (int.from_bytes(digest[:8], "little") ^ size) & mask
+        while True:
+            row = slots[slot]
+            if row < 0:
+                return slot, False
+            offset = row * self._digest_size
+            if self._sizes[row] == size and self._digests[offset:offset + self._digest_size] == digest:
+                return slot, True
+            slot = (slot + 1) & mask
+
+    def _grow_slots(self):
+        """
+         @brief Double the lookup table and re-insert every row, keeping the table at most half full.
+        """
+        slots = array("q", [-1]) * (len(self._slots) * 2)
+        for row in range(len(self._sizes)):
+            offset = row * self._digest_size
+            slot, found = self._find_slot(slots, self._sizes[row], bytes(self._digests[offset:offset + self._digest_size]))
+            slots[slot] = row
+        self._slots = slots
+
+    def _check_digest(self, digest):
+        if len(digest) != self._digest_size:
+            raise ValueError(f"Digest of {len(digest)} bytes given to an index of {self._digest_size}-byte digests")
+
+    def add(self, size, digest, value=0):
+        """
+         @brief Add a (size, digest) pair to the index, if it is not in it yet.
+         @param size Size of the file in bytes
+         @param digest Raw digest of the file
+         @param value Unsigned 64-bit value stored with the pair, e.g. the offset of the keeper path in a RecordStore
+        """
+        self._check_digest(digest)
+        if self.contains(size, digest):
+            return
+        slot, found = self._find_slot(self._slots, size, digest)
+        self._slots[slot] = len(self._sizes)
+        self._sizes.append(size)
+        self._values.append(value)
+        self._digests += digest
+        if len(self._sizes) * 2 > len(self._slots):
+            self._grow_slots()
+        if self.get_memory_usage() > self._memory_limit:
+            self._spill()
+
+    def contains(self, size, digest):
+        """
+         @brief Check whether a (size, digest) pair is in the index, in memory or in one of the spilled runs.
+         @param size Size of the file in bytes
+         @param digest Raw digest of the file
+         @return True if the pair was added before
+        """
+        return self.get(size, digest) is not None
+
+    def get(self, size, digest):
+        """
+         @brief Get the value stored with a (size, digest) pair.
+         @param size Size of the file in bytes
+         @param digest Raw digest of the file
+         @return Value given to add, or None if the pair is not in the index
+        """
+        self._check_digest(digest)
+        slot, found = self._find_slot(self._slots, size, digest)
+        if found:
+            return self._values[self._slots[slot]]
+        key = digest + size.to_bytes(8, "big")
+        for spilled_run in self._spilled_runs:
+            value = self._search_run(spilled_run, key)
+            if value is not None:
+                return value
+        return None
+
+    def _search_run(self, spilled_run, key):
+        """
+         @brief Binary search a key in a spilled run.
+         @param spilled_run Tuple of (file, mmap, record count)
+         @param key digest + big endian size bytes
+         @return Value of the record with the key, or None if the run doesn't hold it
+        """
+        run_file, run_map, record_count = spilled_run
+        low, high = 0, record_count
+        while low < high:
+            middle = (low + high) // 2
+            offset = middle * self._record_size
+            middle_key = run_map[offset:offset + self._key_size]
+            if middle_key == key:
+                return int.from_bytes(run_map[offset + self._key_size:offset + self._record_size], "big")
+            if middle_key < key:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def _iter_memory_records(self):
+        for row in range(len(self._sizes)):
+            offset = row * self._digest_size
+            yield bytes(self._digests[offset:offset + self._digest_size]) + self._sizes[row].to_bytes(8, "big") + self._values[row].to_bytes(8, "big")
+
+    def _iter_run_records(self, spilled_run):
+        run_file, run_map, record_count = spilled_run
+        for offset in range(0, record_count * self._record_size, self._record_size):
+            yield run_map[offset:offset + self._record_size]
+
+    def _write_run(self, records):
+        """
+         @brief Write sorted records to a new run file and map it for lookups.
+         @param records Iterable of sorted records
+         @return Tuple of (file, mmap, record count)
+        """
+        run_file = tempfile.TemporaryFile(prefix="compact-index-", dir=self._spill_dir)
+        record_count = 0
+        for record in records:
+            run_file.write(record)
+            record_count += 1
+        run_file.flush()
+        return run_file, mmap.mmap(run_file.fileno(), 0, access=mmap.ACCESS_READ), record_count
+
+    def _spill(self):
+        """
+         @brief Write the in-memory rows to disk as a sorted run and free their memory. Runs are merged once there are too many.
+        """
+        logger.info(f"Index over {self._memory_limit} bytes, spilling {len(self._sizes)} digests to disk")
+        self._spilled_runs.append(self._write_run(sorted(self._iter_memory_records())))
+        self._spilled_count += len(self._sizes)
+        self._clear_memory()
+        if len(self._spilled_runs) > MAX_SPILLED_RUNS:
+            spilled_runs = self._spilled_runs
+            self._spilled_runs = [self._write_run(heapq.merge(*[self._iter_run_records(spilled_run) for spilled_run in spilled_runs]))]
+            for run_file, run_map, record_count in spilled_runs:
+                run_map.close()
+                run_file.close()
+
+    def close(self):
+        """
+         @brief Close and delete the spilled runs.
+        """
+        for run_file, run_map, record_count in self._spilled_runs:
+            run_map.close()
+            run_file.close()
+        self._spilled_runs = list()
+
+
+class RecordStore:
+    def __init__(self, spill_dir=None):
+        """
+         @brief Initialize the store. Rows are appended as JSON lines to a temporary file and read back by offset or in
+                order, so only their offsets are kept in memory. Recently used rows stay in the page cache
+         @param spill_dir Directory of the temporary file, the system temporary directory by default
+        """
+        self._file = tempfile.TemporaryFile(prefix="record-store-", dir=spill_dir)
+        self._end = 0
+        self._is_at_end = True
+
+    def add(self, row):
+        """
+         @brief Append a row to the store.
+         @param row List of JSON values, strings with undecodable file name bytes are escaped
+         @return Offset of the row, to read it back with get
+        """
+        # Seeking flushes the write buffer, so it is only done after a read moved the position
+        if not self._is_at_end:
+            self._file.seek(self._end)
+            self._is_at_end = True
+        line = (json.dumps(row, separators=(",", ":")) + "\n").encode("ascii")
+        self._file.write(line)
+        offset, self._end = self._end, self._end + len(line)
+        return offset
+
+    def get(self, offset):
+        """
+         @brief Read back a row.
+         @param offset Offset returned by add
+         @return List of the row values
+        """
+        self._file.seek(offset)
+        self._is_at_end = False
+        return json.loads(self._file.readline())
+
+    def iter_rows(self):
+        """
+         @brief Read back every row in the order they were added. Rows must not be added while iterating
+         @return Iterator over the lists of row values
+        """
+        self._file.seek(0)
+        self._is_at_end = False
+        position = 0
+        while position < self._end:
+            line = self._file.readline()
+            position += len(line)
+            yield json.loads(line)
+
+    def close(self):
+        """
+         @brief Close and delete the temporary file.
+        """
+        self._file.close()
@@ -9,13 +9,15 @@ class Config:
         self.config = json.load(open(file_path, encoding='utf-8'))
         self._root_dir, _os_name = None, None
 
-    def get(self, param):
+    def get(self, param, default=None):
         """
          @brief Get a parameter from the configuration. This is a shortcut for config [ param ]. The default implementation returns the value of the configuration parameter.
          @param param Name of the parameter to get. E. g.
-         @return Value of the parameter or None if not set or the parameter doesn't exist in the configuration file
+         @param default Value returned when the parameter is not set, so older config files keep working
+         @return Value of the parameter or default if not set or the parameter doesn't exist in the configuration file
         """
-        return self.config.get(param)
+        value = self.config.get(param)
+        return default if value is None else value
 
     def set_root_dir(self, root_dir):
         self._root_dir = root_dir
@@ -3,16 +3,69 @@ import json
 from tkinter import filedialog
 import os
 settings = {
+  "ROOT_DIR": None,
   "BUFF_SIZE": 65536,
   "FILE_EXTENSIONS": [],
   "DEST_PATH": None,
   "BASE_PATH": [],
   "IS_CACHE_WRITABLE": None,
-  "IS_CACHE_READABLE": None
+  "IS_CACHE_READABLE": None,
+  "PARTIAL_HASH_SIZE": 16384,
+  "PARTIAL_HASH_SAMPLES": 3,
+  "BATCH_SIZE": 256,
+  "WALK_THREADS": 8,
+  "HASH_WORKERS": None,
+  "HASH_EXECUTOR": "process",
+  "BATCH_BYTES": 268435456,
+  "PARTIAL_HASH_ALGORITHM": "blake2b",
+  "HASH_ALGORITHM": "blake2b",
+  "MAX_BUFF_SIZE": 4194304,
+  "MMAP_MIN_SIZE": 0,
+  "FADVISE": True,
+  "INDEX_MEMORY_LIMIT": 1073741824,
+  "INDEX_SPILL_DIR": None,
+  "SCAN_RUN_ROWS": 1000000,
+  "CACHE_COMMIT_ROWS": 10000,
+  "CACHE_COMMIT_SECONDS": 30,
+  "PRUNE_CACHE": True,
+  "USE_PRIVILEGED_HELPER": True,
+  "LOG_FLUSH_SECONDS": 5,
+  "DEDUP_MODE": "remove",
+  "MOVE_UNIQUE_FILES": True,
+  "RUN_MODE": "run",
+  "PLAN_PATH": None,
+  "KEEPER_POLICY": "path",
+  "PREFERRED_ROOTS": [],
+  "VERIFY_DUPLICATES": False,
+  "VERIFY_CHUNK_SIZE": 1048576,
+  "VERIFY_WORKERS": 2,
+  "LOG_LEVEL": "INFO",
+  "PROGRESS_SECONDS": 5,
+  "STATS_SECONDS": 30,
+  "STATS_PATH": None,
+  "METRICS_PORT": None,
+  "WATCH_MODE": "auto",
+  "DEBOUNCE_SECONDS": 2,
+  "RESCAN_SECONDS": 300,
+  "NEAR_DUPLICATES": False,
+  "NEAR_DUPLICATE_DISTANCE": 6,
+  "NEAR_DUPLICATE_PATH": None,
+  "NODE_NAME": None,
+  "SHARD_PATH": None,
+  "SHARD_RUN_ROWS": 1000000,
+  "SHARD_PLAN_DIR": None,
+  "TRUST_REMOTE_KEEPERS": False,
+  "INCLUDE_PATTERNS": [],
+  "EXCLUDE_PATTERNS": [],
+  "MIN_FILE_SIZE": 0,
+  "MAX_FILE_SIZE": None
 }
 
 def save_settings():
-    settings["BUFF_SIZE"] = 65536
+    try:
+        settings["BUFF_SIZE"] = int(buffer_size_entry.get())
+    except ValueError:
+        settings["BUFF_SIZE"] = 65536
     settings["IS_CACHE_WRITABLE"] = bool(cache_writable_var.get())
     settings["IS_CACHE_READABLE"] = bool(cache_readable_var.get())
     print(settings)
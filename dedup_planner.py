@@ -0,0 +1,136 @@
+import os
+import json
+
+KEEPER_POLICIES = ("path", "oldest", "shortest_path", "preferred_root")
+
+
+class DedupPlanner:
+    def __init__(self, config):
+        """
+         @brief Initialize the planner. It groups hashed files into duplicate groups, picks the keeper of each group with
+                the KEEPER_POLICY and reads and writes the groups as a JSON Lines plan, one group per line
+         @param config A config object that contains the configuration for the task
+        """
+        self._config = config
+        self._keeper_policy = self._config.get("KEEPER_POLICY", "path")
+        if self._keeper_policy not in KEEPER_POLICIES:
+            print(f"Unknown KEEPER_POLICY {self._keeper_policy}, keep the first path instead")
+            self._keeper_policy = "path"
+        self._preferred_roots = self._config.get("PREFERRED_ROOTS", [])
+
+    def get_plan_path(self):
+        """
+         @brief Get the path of the plan file.
+         @return PLAN_PATH, or plan/duplicates.jsonl in the root directory by default
+        """
+        return self._config.get("PLAN_PATH", f"{self._config.get_root_dir()}plan/duplicates.jsonl")
+
+    def get_near_duplicate_path(self):
+        """
+         @brief Get the path of the near-duplicate report.
+         @return NEAR_DUPLICATE_PATH, or plan/near-duplicates.jsonl in the root directory by default
+        """
+        return self._config.get("NEAR_DUPLICATE_PATH", f"{self._config.get_root_dir()}plan/near-duplicates.jsonl")
+
+    def _get_root_rank(self, path):
+        """
+         @brief Get the rank of the first PREFERRED_ROOTS entry a path is under.
+         @param path Path of the file
+         @return Index of the root in PREFERRED_ROOTS, or its length if the path is under none of them
+        """
+        for rank, root in enumerate(self._preferred_roots):
+            if path.startswith(root):
+                return rank
+        return len(self._preferred_roots)
+
+    def get_keeper_key(self, file_record):
+        """
+         @brief Get the sort key of a file for the KEEPER_POLICY. The file with the smallest key in a group is kept, ties
+                are broken by path so the same tree always keeps the same file
+         @param file_record Tuple of (path, size, file key)
+         @return Tuple to sort the files of a group by
+        """
+        path, size, file_key = file_record
+        if self._keeper_policy == "oldest":
+            # The file key ends with the modification time, so the oldest file is found without a stat
+            return int(file_key.rsplit(":", 1)[1]), path
+        if self._keeper_policy == "shortest_path":
+            return len(path), path
+        if self._keeper_policy == "preferred_root":
+            return self._get_root_rank(path), path
+        return (path,)
+
+    @staticmethod
+    def get_inode(file_key):
+        """
+         @brief Get the device and inode part of a file key. Paths hardlinked to each other share it
+         @param file_key String of the form dev:inode:size:mtime_ns
+         @return String of the form dev:inode
+        """
+        return file_key.rsplit(":", 2)[0]
+
+    def build_groups(self, hashed_files, reference_paths):
+        """
+         @brief Group hashed files by size and hash and pick the keeper of each group. Files kept by a previous run are
+                never planned for removal, so when a group has some, the keeper is one of them. Paths already hardlinked
+                to the keeper free nothing, so they are left out of the duplicates
+         @param hashed_files List of ((path, size, file key), hash) tuples
+         @param reference_paths Set of the paths kept by previous runs
+         @return List of groups sorted by hash, each a dictionary with "size", "hash", "keeper" as a (path, file key) pair and
+                 "duplicates" as a list of (path, file key) pairs
+        """
+        grouped_files = dict()
+        for file_record, file_hash in hashed_files:
+            grouped_files.setdefault((file_record[1], file_hash), []).append(file_record)
+        groups = list()
+        for (size, file_hash), file_records in sorted(grouped_files.items(), key=lambda item: item[0][1]):
+            if all(file_record[0] in reference_paths for file_record in file_records):
+                continue
+            keeper_candidates = [file_record for file_record in file_records if file_record[0] in reference_paths] or file_records
+            keeper = min(keeper_candidates, key=self.get_keeper_key)
+            keeper_inode = self.get_inode(keeper[2])
+            duplicates = sorted((file_record for file_record in file_records if file_record[0] not in reference_paths
+                                 and self.get_inode(file_record[2]) != keeper_inode), key=self.get_keeper_key)
+            if duplicates:
+                groups.append({"size": size, "hash": file_hash, "keeper": [keeper[0], keeper[2]],
+                               "duplicates": [[path, file_key] for path, size, file_key in duplicates]})
+        return groups
+
+    def write_plan(self, groups, plan_path):
+        """
+         @brief Write duplicate groups to a plan file, replacing it only once it is complete. Near-duplicate groups are
+                written the same way, one group per line
+         @param groups List of groups as returned by build_groups
+         @param plan_path Path of the plan file
+         @return Tuple of (number of duplicates, reclaimable bytes)
+        """
+        os.makedirs(os.path.dirname(plan_path) or ".", exist_ok=True)
+        duplicate_count, reclaimable_size = 0, 0
+        with open(plan_path + ".tmp", "w", encoding="utf-8") as plan_file:
+            for group in groups:
+                plan_file.write(json.dumps(group, ensure_ascii=False, separators=(",", ":")) + "\n")
+                duplicate_count += len(group["duplicates"])
+                reclaimable_size += self._get_reclaimable_size(group)
+        os.replace(plan_path + ".tmp", plan_path)
+        return duplicate_count, reclaimable_size
+
+    def _get_reclaimable_size(self, group):
+        """
+         @brief Get the bytes freed by removing the duplicates of a group. Duplicates hardlinked to each other are counted once
+         @param group Duplicate group, or near-duplicate group whose duplicates each carry their own size
+         @return Size in bytes
+        """
+        if "size" in group:
+            return group["size"] * len(set(self.get_inode(file_key) for path, file_key in group["duplicates"]))
+        return sum(duplicate[2] for duplicate in group["duplicates"])
+
+    def read_plan(self, plan_path):
+        """
+         @brief Read the groups of a plan file.
+         @param plan_path Path of the plan file
+         @return Iterator over the groups, in the format of build_groups
+        """
+        with open(plan_path, "r", encoding="utf-8") as plan_file:
+            for line in plan_file:
+                if line.strip():
+                    yield json.loads(line)
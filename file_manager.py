@@ -1,10 +1,34 @@
-import os, stat, sys
-import shutil
-import hashlib
-import pathlib
+import os, sys
+import stat
+import time
+import signal
+import socket
+import logging
+import mmap
+import heapq
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from config import Config
 from shared_data import SharedData
+from hash_dispatcher import HashDispatcher
+from hasher import Hasher
+from action_executor import ActionExecutor
+from log_writer import LogWriter
+from dedup_planner import DedupPlanner
+from file_verifier import FileVerifier
+from metrics import Metrics
+from inotify_watcher import InotifyWatcher, is_network_mount
+from perceptual_hasher import PerceptualHasher, IMAGE_EXTENSIONS, split_fingerprint
+from multi_index_hash import MultiIndexHash
+from index_shard import ShardWriter
+from path_filter import PathFilter
+from size_buckets import SizeBuckets
+
+# Per-file messages go through this logger, LOG_LEVEL "WARNING" keeps only the errors
+logger = logging.getLogger("file_manager")
 
 
 class FileManager:
@@ -16,19 +40,34 @@ class FileManager:
         """
         self._config = config
         self.shared_data = shared_data
-        self.dir_paths = list()
+        # Partial hashes only filter candidates, so they can use a faster non-cryptographic hash such as "xxh3_128" when
+        # the optional xxhash package is installed, full hashes decide what is removed
+        self._partial_hasher = Hasher(self._config.get("PARTIAL_HASH_ALGORITHM", "blake2b"))
+        self._hasher = Hasher(self._config.get("HASH_ALGORITHM", "blake2b"))
+        # Read buffers are reused per thread, the pool may run hashing in threads
+        self._buffers = threading.local()
+        self._rotational_devices = dict()
+        self._path_filter = PathFilter(self._config)
+        # Neither opens anything until the first action, so hashing workers don't pay for them
+        self._action_executor = ActionExecutor(self._config)
+        self._log_writer = LogWriter(f"{self._config.get_root_dir()}log/", self._config.get("LOG_FLUSH_SECONDS", 5))
+        self._planner = DedupPlanner(self._config)
+        self._metrics = Metrics(self._config)
+        # Created by the workers that fingerprint images, when NEAR_DUPLICATES is set
+        self._perceptual_hasher = None
+        # Duplicates are only compared byte by byte to their keeper when VERIFY_DUPLICATES is set
+        self._verifier = None
+        if self._config.get("VERIFY_DUPLICATES", False):
+            self._verifier = FileVerifier(self._config.get("VERIFY_CHUNK_SIZE", 1048576), self._config.get("VERIFY_WORKERS", 2))
 
-    def _is_file_size_duplicated(self, file_size):
+    def _is_file_duplicated(self, file_size, file_hash):
         """
-         @brief Checks if the file size is duplicated. This is used to prevent duplicate files from appearing in the list of files
+         @brief Checks if a file with the same size and hash was kept before. This is used to prevent duplicate files from appearing in the list of files
          @param file_size The size of the file
-         @return True if the file size is duplicated False if it is not in the list of files or if the file size is
+         @param file_hash Hash of the file
+         @return True if the file is duplicated False if no kept file has this size and hash
         """
-        # Returns True if the file size is in bytes.
-        if self.shared_data.get_size(str(file_size)):
-            return True
-        else:
-            return False
+        return self.shared_data.has_file_digest(file_size, file_hash)
 
     def _get_file_size(self, file_path):
         """
@@ -40,35 +79,129 @@ class FileManager:
         file_size = file_stats.st_size
         return file_size
 
+    def _is_rotational_device(self, device):
+        """
+         @brief Check whether a device is a spinning disk, from /sys/dev/block on Linux. Results are cached per device
+         @param device st_dev of a file on the device
+         @return True for spinning disks, False for SSDs and when the device type can't be found
+        """
+        if device not in self._rotational_devices:
+            sys_path = f"/sys/dev/block/{os.major(device)}:{os.minor(device)}"
+            is_rotational = False
+            # Partitions have no queue of their own, their parent device does
+            for queue_path in (f"{sys_path}/queue/rotational", f"{sys_path}/../queue/rotational"):
+                try:
+                    with open(queue_path) as f:
+                        is_rotational = f.read().strip() == "1"
+                    break
+                except OSError:
+                    continue
+            self._rotational_devices[device] = is_rotational
+        return self._rotational_devices[device]
+
+    def _get_buffer_size(self, file_stats):
+        """
+         @brief Get the read buffer size for a file. It starts at BUFF_SIZE and doubles up to MAX_BUFF_SIZE as the file grows,
+                spinning disks always get MAX_BUFF_SIZE to keep seeks between reads rare
+         @param file_stats Result of os.stat for the file
+         @return Buffer size in bytes
+        """
+        buff_size = self._config.get("BUFF_SIZE", 65536)
+        max_buff_size = max(buff_size, self._config.get("MAX_BUFF_SIZE", 4194304))
+        if hasattr(os, "major") and self._is_rotational_device(file_stats.st_dev):
+            return max_buff_size
+        while buff_size < max_buff_size and buff_size * 64 < file_stats.st_size:
+            buff_size *= 2
+        return buff_size
+
+    def _get_buffer(self, buff_size):
+        """
+         @brief Get the read buffer of the current thread, so hashing doesn't allocate a new bytes object per read
+         @param buff_size Minimum size of the buffer in bytes
+         @return memoryview of a buffer of at least buff_size bytes
+        """
+        if getattr(self._buffers, "buffer", None) is None or len(self._buffers.buffer) < buff_size:
+            self._buffers.buffer = memoryview(bytearray(buff_size))
+        return self._buffers.buffer
+
+    def _advise_file(self, file_descriptor, advice):
+        """
+         @brief Give an access pattern hint for a file to the kernel, where posix_fadvise is available
+         @param file_descriptor Descriptor of the open file
+         @param advice Name of the os.POSIX_FADV_* constant, e.g. "POSIX_FADV_SEQUENTIAL"
+        """
+        if hasattr(os, "posix_fadvise") and self._config.get("FADVISE", True):
+            try:
+                os.posix_fadvise(file_descriptor, 0, 0, getattr(os, advice))
+            except OSError:
+                pass
+
     def _get_file_hash(self, file_path):
         """
-         @brief Calculate md5 hash of file. This is used to verify file integrity in case of large files.
+         @brief Calculate the HASH_ALGORITHM hash of file. This is used to verify file integrity in case of large files.
+                Files are read into a reused buffer, or memory mapped from MMAP_MIN_SIZE bytes when it is set. The kernel
+                is told the file is read once sequentially and its pages are dropped afterwards, so a scan doesn't evict
+                the page cache of other programs
          @param file_path Path to file to hash. Must be absolute or relative to self. _root_path.
-         @return MD5 hash of file as hex string. May be empty if file doesn't exist or is too large
+         @return Hash of file as algorithm:hexdigest string
         """
-        md5 = hashlib.md5()
-        with open(file_path, 'rb') as f:
-            # Read the data from the file.
-            while True:
-                data = f.read(self._config.get("BUFF_SIZE"))
-                # If data is not empty break the loop.
-                if not data:
-                    break
-                md5.update(data)
-        md5_hash = md5.hexdigest()
-        return md5_hash
+        file_hash = self._hasher.new()
+        with open(file_path, 'rb', buffering=0) as f:
+            file_descriptor = f.fileno()
+            file_stats = os.fstat(file_descriptor)
+            buff_size = self._get_buffer_size(file_stats)
+            self._advise_file(file_descriptor, "POSIX_FADV_SEQUENTIAL")
+            # Memory mapping is off by default: a file truncated while mapped kills the worker with SIGBUS
+            mmap_min_size = self._config.get("MMAP_MIN_SIZE", 0)
+            if mmap_min_size and file_stats.st_size >= mmap_min_size:
+                with mmap.mmap(file_descriptor, 0, access=mmap.ACCESS_READ) as mapped_file:
+                    if hasattr(mapped_file, "madvise"):
+                        mapped_file.madvise(mmap.MADV_SEQUENTIAL)
+                    with memoryview(mapped_file) as mapped_view:
+                        for offset in range(0, len(mapped_view), buff_size):
+                            file_hash.update(mapped_view[offset:offset + buff_size])
+            else:
+                buffer = self._get_buffer(buff_size)[:buff_size]
+                # Read the data from the file.
+                while True:
+                    read_size = f.readinto(buffer)
+                    # If data is not empty break the loop.
+                    if not read_size:
+                        break
+                    file_hash.update(buffer[:read_size])
+            self._advise_file(file_descriptor, "POSIX_FADV_DONTNEED")
+        return self._hasher.get_digest(file_hash)
 
-    def _is_file_hash_duplicated(self, md5_hash):
+    def _get_partial_hash_offsets(self, file_size):
         """
-         @brief Check if file hash is duplicated. This is used to prevent duplicates in shared data. The hash is compared to the MD5 hash of the file being duplicated
-         @param md5_hash MD5 hash of the file being duplicated
-         @return True if the hash is duplicated False if it is not in the shared data or if it is not
+         @brief Get the offsets of the blocks read by the partial hash: the head, PARTIAL_HASH_SAMPLES evenly spaced blocks and the tail.
+         @param file_size The size of the file in bytes
+         @return List of block offsets, or None if the blocks would cover the whole file and a full hash is as cheap
         """
-        # Returns True if the hash is valid for the shared data.
-        if self.shared_data.get_hash(md5_hash):
-            return True
-        else:
-            return False
+        block_size = self._config.get("PARTIAL_HASH_SIZE", 16384)
+        sample_count = self._config.get("PARTIAL_HASH_SAMPLES", 3)
+        if block_size <= 0 or file_size <= block_size * (sample_count + 2):
+            return None
+        offsets = [0]
+        offsets.extend(file_size * i // (sample_count + 1) for i in range(1, sample_count + 1))
+        offsets.append(file_size - block_size)
+        return offsets
+
+    def _get_partial_file_hash(self, file_path, file_size):
+        """
+         @brief Calculate the PARTIAL_HASH_ALGORITHM hash of the head, tail and sampled blocks of a file. Files with a different partial hash can't be duplicates
+         @param file_path Path to file to hash
+         @param file_size The size of the file in bytes
+         @return Hash of the sampled blocks as algorithm:hexdigest string
+        """
+        block_size = self._config.get("PARTIAL_HASH_SIZE", 16384)
+        buffer = self._get_buffer(block_size)[:block_size]
+        partial_hash = self._partial_hasher.new()
+        with open(file_path, 'rb', buffering=0) as f:
+            for offset in self._get_partial_hash_offsets(file_size):
+                f.seek(offset)
+                partial_hash.update(buffer[:f.readinto(buffer)])
+        return self._partial_hasher.get_digest(partial_hash)
 
     def _get_file_name(self, file_path):
         splitted_file_path = file_path.split("/")
@@ -76,121 +209,934 @@ class FileManager:
         return file_name
 
     def _write_log(self, log_content, log_name):
-        f = open(f"{self._config.get_root_dir()}log/{log_name}", "a", encoding="utf-8")
-        f.write(log_content + "\n")
-        f.close()
+        self._log_writer.write(log_content, log_name)
 
     def move_to_parent_folder(self, file_path, file_size):
+        """
+         @brief Move a unique file into DEST_PATH and account for it in the moved totals.
+         @param file_path Path to the file to move
+         @param file_size Size of the file in bytes
+         @return Path the file ends up at, or None if the file could not be moved
+        """
         dest_path = f'{self._config.get("DEST_PATH")}{self._get_file_name(file_path)}'
         try:
-            if "win" in self._config.get_os_name():
-                shutil.move(file_path, dest_path)
-            else:
-                os.system(f"sudo mv {file_path} {dest_path}")
-            print(f"File moved from {file_path} to {dest_path}")
-            self._write_log(f"File moved from {file_path} to {dest_path}", "moved.txt")
-            self.shared_data.add_total_moved_size(file_size / pow(1024, 3))
-            self.shared_data.add_total_moved_count(1)
-        except:
-            # path contains the path of the file that couldn't be removed
-            # let's just assume that it's read-only and unlink it.
-            print("Read_only file detected")
-            os.chmod(file_path, stat.S_IWRITE)
-            os.unlink(file_path)
-
-    def remove_duplicate_file(self, file_path, move_file):
+            dest_path = self._action_executor.move(file_path, dest_path)
+        except OSError as e:
+            # The file is unique, so it stays where it is rather than being lost
+            logger.error(f"Error: {file_path} cannot be moved, {e}")
+            return None
+        logger.info(f"File moved from {file_path} to {dest_path}")
+        self._write_log(f"File moved from {file_path} to {dest_path}", "moved.txt")
+        self.shared_data.add_total_moved_size(file_size / pow(1024, 3))
+        self.shared_data.add_total_moved_count(1)
+        self._metrics.add("moved_files")
+        return dest_path
+
+    def _keep_unique_file(self, file_path, file_size, file_hash, move_file):
+        """
+         @brief Register a file that has no duplicate so later files of the same size and hash are treated as duplicates.
+         @param file_path Path to the file
+         @param file_size Size of the file in bytes
+         @param file_hash Hash of the file, or None if its size was unique and it was never hashed
+         @param move_file Move the file into DEST_PATH when True
+         @return Path the file is kept at
+        """
+        kept_path = file_path
+        if move_file:
+            kept_path = self.move_to_parent_folder(file_path, file_size) or file_path
+        if file_hash is not None:
+            self.shared_data.add_file_digest(file_size, file_hash, kept_path)
+        logger.info(f"New file {file_path} detected")
+        self._write_log(f"New file {file_path} detected", "unique_file_detected.txt")
+        return kept_path
+
+    def _link_duplicate_file(self, file_path, file_size, keeper_path):
+        """
+         @brief Replace a duplicate with a hardlink or reflink of its keeper, as set by DEDUP_MODE. The path stays readable
+                the whole time, only the duplicated blocks are freed
+         @param file_path Path to the duplicate
+         @param file_size Size of the file in bytes
+         @param keeper_path Path of the kept file with the same content, or None if unknown
+         @return Path of the file, which is kept
+        """
+        dedup_mode = self._config.get("DEDUP_MODE")
+        try:
+            if keeper_path is None or os.path.samefile(keeper_path, file_path):
+                return file_path
+            self._action_executor.link(file_path, keeper_path, dedup_mode)
+        except OSError as e:
+            logger.error(f"Error: {file_path} cannot be linked to {keeper_path}, {e}")
+            return file_path
+        self._record_linked(file_path, keeper_path, file_size)
+        return file_path
+
+    def _record_linked(self, file_path, keeper_path, file_size):
+        """
+         @brief Log a duplicate replaced by a link to its keeper and add it to the linked totals.
+         @param file_path Path to the duplicate
+         @param keeper_path Path of the keeper it is linked to
+         @param file_size Size of the file in bytes
+        """
+        dedup_mode = self._config.get("DEDUP_MODE")
+        logger.info(f"Link {file_path} to {keeper_path} with a {dedup_mode}. Free {file_size} bytes")
+        self._write_log(f"Link {file_path} to {keeper_path} with a {dedup_mode}. Free {file_size} bytes", "linked.txt")
+        self.shared_data.add_total_linked_size(file_size / pow(1024, 3))
+        self.shared_data.add_total_linked_count(1)
+        self._metrics.add("linked_files")
+        self._metrics.add("linked_bytes", file_size)
+
+    def remove_duplicate_file(self, file_path, move_file, file_size=None, file_hash=None, is_verified=True):
         """
          @brief Remove file_path if it is new. This method is called by FileManager when a file is removed from the storage
          @param file_path Path to the file
+         @param move_file Move the file into DEST_PATH when it is not a duplicate
+         @param file_size Size of the file in bytes, computed when not given
+         @param file_hash Hash of the file, computed when not given
+         @param is_verified False if the file was compared to its keeper and differs, it is then kept where it is
+         @return Path the file is kept at, or None if it was removed as a duplicate
         """
-        file_size, file_hash = self._get_file_size(file_path), self._get_file_hash(file_path)
+        if file_size is None:
+            file_size = self._get_file_size(file_path)
+        if file_hash is None:
+            file_hash = self._get_file_hash(file_path)
         # if file_size and file_hash are duplicated
-        if self._is_file_size_duplicated(file_size) and self._is_file_hash_duplicated(file_hash):
-            print(f"Remove {file_path} due to duplication. Free {file_size} bytes")
+        if self._is_file_duplicated(file_size, file_hash):
+            return self._dedup_file(file_path, file_size, self.shared_data.get_keeper_path(file_size, file_hash), is_verified)
+        else:
+            return self._keep_unique_file(file_path, file_size, file_hash, move_file)
+
+    def _dedup_file(self, file_path, file_size, keeper_path, is_verified=True):
+        """
+         @brief Remove a duplicate, or link it to its keeper when DEDUP_MODE is "hardlink" or "reflink".
+         @param file_path Path to the duplicate
+         @param file_size Size of the file in bytes
+         @param keeper_path Path of the kept file with the same content, only needed to link
+         @param is_verified False if the file was compared to its keeper and differs, it is then kept where it is
+         @return Path the file is kept at, or None if it was removed
+        """
+        if not is_verified:
+            logger.warning(f"{file_path} has the hash of a kept file but different bytes, keep it")
+            self._write_log(f"{file_path} has the hash of a kept file but different bytes, keep it", "verification_failed.txt")
+            return file_path
+        if self._config.get("DEDUP_MODE", "remove") != "remove":
+            return self._link_duplicate_file(file_path, file_size, keeper_path)
+        try:
+            self._action_executor.remove(file_path)
+        except OSError as e:
+            logger.error(f"Error: file cannot be removed, {e}")
+            return file_path
+        self._record_removed(file_path, file_size)
+        return None
+
+    def _record_removed(self, file_path, file_size):
+        """
+         @brief Log a removed duplicate and add it to the removal totals.
+         @param file_path Path to the removed duplicate
+         @param file_size Size of the file in bytes
+        """
+        logger.info(f"Remove {file_path} due to duplication. Free {file_size} bytes")
+        self._write_log(f"Remove {file_path} due to duplication. Free {file_size} bytes", "removed.txt")
+        self.shared_data.add_total_removal_size(file_size / pow(1024, 3))
+        self.shared_data.add_total_removal_count(1)
+        self._metrics.add("removed_files")
+        self._metrics.add("removed_bytes", file_size)
+
+    def _get_file_key(self, file_stats):
+        """
+         @brief Build the file index key of a file. The key changes whenever the file is replaced or modified
+         @param file_stats Result of os.stat for the file
+         @return String of the form dev:inode:size:mtime_ns
+        """
+        return f"{file_stats.st_dev}:{file_stats.st_ino}:{file_stats.st_size}:{file_stats.st_mtime_ns}"
+
+    def scan_dir(self, dir_path):
+        """
+         @brief Scan a single directory with os.scandir. The entry types come from the directory listing, so only target files are stat'ed
+         @param dir_path Path of the directory, ending with a "/"
+         @return Tuple of (sub directory paths, list of (path, size, file key) tuples). Symbolic links, DEST_PATH and
+                 the files and directories filtered out by the PathFilter are skipped
+        """
+        sub_dir_paths, file_records = list(), list()
+        start_time, stat_seconds = time.perf_counter(), 0.0
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            sub_dir_path = entry.path + "/"
+                            # Excluded subtrees are pruned here, before anything below them is listed
+                            if not self._path_filter.is_excluded_dir(sub_dir_path):
+                                sub_dir_paths.append(sub_dir_path)
+                        elif entry.is_file(follow_symlinks=False) and self._path_filter.is_target_file(entry.name, entry.path):
+                            stat_start_time = time.perf_counter()
+                            file_stats = entry.stat(follow_symlinks=False)
+                            # Windows doesn't fill in the inode from the directory listing
+                            if not file_stats.st_ino:
+                                file_stats = os.stat(entry.path, follow_symlinks=False)
+                            stat_seconds += time.perf_counter() - stat_start_time
+                            if self._path_filter.is_target_size(file_stats.st_size):
+                                file_records.append((entry.path, file_stats.st_size, self._get_file_key(file_stats)))
+                    except OSError as e:
+                        logger.warning(e)
+        except OSError:
+            logger.warning(f"{dir_path} - Access denied, skip")
+        # Summed over the walk threads, like the hashing stages are summed over the workers
+        self._metrics.add_stage_time("walk", time.perf_counter() - start_time - stat_seconds)
+        self._metrics.add_stage_time("stat", stat_seconds)
+        return sub_dir_paths, file_records
+
+    def walk_files(self, base_paths=None):
+        """
+         @brief Walk every BASE_PATH without recursion. Directories are scanned concurrently by WALK_THREADS threads and
+                files are yielded as soon as their directory is scanned, so the caller can start hashing before the walk ends
+         @param base_paths Paths to walk instead of BASE_PATH
+         @return Iterator over (path, size, file key) tuples
+        """
+        base_paths = set(base_path for base_path in (base_paths or self._config.get("BASE_PATH")) if not self._path_filter.is_excluded_dir(base_path))
+        with ThreadPoolExecutor(max_workers=self._config.get("WALK_THREADS", 8)) as executor:
+            pending = set(executor.submit(self.scan_dir, base_path) for base_path in base_paths)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    sub_dir_paths, file_records = future.result()
+                    pending.update(executor.submit(self.scan_dir, sub_dir_path) for sub_dir_path in sub_dir_paths)
+                    self._metrics.set_gauge("pending_dirs", len(pending))
+                    yield from file_records
+
+    def _get_size_references(self, file_size, scanned_path, reference_records):
+        """
+         @brief Look up the indexed files of a size, the first time a scanned file has that size. Entries whose file is gone
+                or changed are pruned, the other files are references to compare the scanned files against
+         @param file_size Size of the files in bytes
+         @param scanned_path Path of the scanned file, skipped if it is indexed itself
+         @param reference_records Dictionary mapping a path to its (path, size, file key) tuple, the references are added to it
+         @return List of (path, size, file key) tuples of the references
+        """
+        size_references = list()
+        for path, file_key in self.shared_data.get_indexed_files_by_size(file_size):
+            if path == scanned_path:
+                continue
+            try:
+                file_stats = os.stat(path)
+            except OSError:
+                self.shared_data.remove_indexed_path(path)
+                continue
+            if self._get_file_key(file_stats) != file_key:
+                self.shared_data.remove_indexed_path(path)
+                continue
+            reference_records[path] = (path, file_size, file_key)
+            size_references.append(reference_records[path])
+        return size_references
+
+    def _prune_file_index(self):
+        """
+         @brief Remove the file index entries whose file is gone or changed. Costs one stat per indexed file, PRUNE_CACHE turns it off
+        """
+        pruned_count = 0
+        for path, file_key in self.shared_data.iter_indexed_files():
             try:
-                if 'win' in self._config.get_os_name():
-                    os.remove(file_path)
+                is_stale = self._get_file_key(os.stat(path)) != file_key
+            except OSError:
+                is_stale = True
+            if is_stale:
+                self.shared_data.remove_indexed_path(path)
+                pruned_count += 1
+        print(f"Pruned {pruned_count} stale files from the file index")
+
+    def _get_hash_field(self, file_size):
+        """
+         @brief Get the first kind of hash computed for files of a given size whose size collides.
+         @param file_size The size of the file in bytes
+         @return "partial" for files large enough for a partial hash to save reads, "hash" otherwise
+        """
+        return "hash" if self._get_partial_hash_offsets(file_size) is None else "partial"
+
+    def hash_file_batch(self, hash_field, file_records):
+        """
+         @brief Hash a batch of file records. Runs in the worker pool
+         @param hash_field Kind of hash to compute, "partial" or "hash"
+         @param file_records List of (path, size, file key) tuples
+         @return Tuple of (list of ((path, size, file key), hash) tuples, hash being None if the file could not be read,
+                 number of bytes read, seconds spent)
+        """
+        start_time = time.perf_counter()
+        hashed_files, read_size = list(), 0
+        for file_record in file_records:
+            path, size, file_key = file_record
+            try:
+                if hash_field == "partial":
+                    hashed_files.append((file_record, self._get_partial_file_hash(path, size)))
+                    read_size += len(self._get_partial_hash_offsets(size)) * self._config.get("PARTIAL_HASH_SIZE", 16384)
                 else:
-                    os.system(f"sudo rm {file_path}")
-                self._write_log(f"Remove {file_path} due to duplication. Free {file_size} bytes", "removed.txt")
-                self.shared_data.add_total_removal_size(file_size / pow(1024, 3))
-                self.shared_data.add_total_removal_count(1)
-            except:
-                print("Error: file cannot be removed")
-        else:
-            self.shared_data.set_hash(file_hash, True)
-            self.shared_data.set_size(str(file_size), True)
-            if move_file:
-                self.move_to_parent_folder(file_path, file_size)
-            print(f"New file {file_path} detected")
-            self._write_log(f"New file {file_path} detected", "unique_file_detected.txt")
+                    hashed_files.append((file_record, self._get_file_hash(path)))
+                    read_size += size
+            except Exception as e:
+                logger.error(e)
+                hashed_files.append((file_record, None))
+        return hashed_files, read_size, time.perf_counter() - start_time
+
+    def _create_pool(self):
+        """
+         @brief Create the hashing worker pool. HASH_EXECUTOR "process" suits CPU-bound hashing of local disks, "thread"
+                suits I/O-bound hashing of network mounts, hashlib releases the GIL while hashing large blocks
+         @return Pool or ThreadPool with HASH_WORKERS workers, the CPU count by default
+        """
+        pool_class = ThreadPool if self._config.get("HASH_EXECUTOR", "process") == "thread" else Pool
+        return pool_class(self._config.get("HASH_WORKERS"), initializer=init_hash_worker, initargs=(self._config,))
+
+    def _create_hash_dispatcher(self, pool):
+        """
+         @brief Create a dispatcher sending files to the hashing worker pool.
+         @param pool Pool returned by _create_pool
+         @return HashDispatcher
+        """
+        return HashDispatcher(hash_file_batch, pool, self.shared_data, self._config.get("BATCH_SIZE", 256), self._config.get("BATCH_BYTES", 268435456),
+                              {"partial": self._partial_hasher, "hash": self._hasher}, self._metrics)
+
+    def _scan_and_dispatch(self, hash_dispatcher):
+        """
+         @brief Walk the base paths and bucket the files by size, together with the indexed files of the same sizes. Files
+                are sent for hashing as soon as their size collides
+         @param hash_dispatcher HashDispatcher sending the files to the worker pool
+         @return Tuple of (scanned file count, SizeBuckets of the files, dictionary mapping a path to its (path, size, file key)
+                 tuple for the references, files kept by previous runs that the walk did not find again)
+        """
+        size_buckets, reference_records = SizeBuckets(self._config.get("INDEX_SPILL_DIR")), dict()
+        scanned_count = 0
+        for file_record in self.walk_files():
+            scanned_count += 1
+            self._metrics.add("scanned_files")
+            self._metrics.add("scanned_bytes", file_record[1])
+            self._metrics.report()
+            path, size = file_record[0], file_record[1]
+            reference_record = reference_records.pop(path, None)
+            if reference_record is not None:
+                # An unchanged reference was sent for hashing with its bucket already
+                if reference_record == file_record:
+                    continue
+                del size_buckets.get_bucket(reference_record[1])[path]
+            size_bucket = size_buckets.get_bucket(size)
+            if size_bucket is not None:
+                # Nested base paths walk the same files twice
+                if path not in size_bucket:
+                    size_bucket[path] = file_record
+                    hash_dispatcher.dispatch((file_record,), self._get_hash_field(size))
+                continue
+            if size_buckets.is_seen(size):
+                single_record = size_buckets.pop_single(size)
+                size_bucket = {single_record[0]: single_record}
+            else:
+                size_bucket = {record[0]: record for record in self._get_size_references(size, path, reference_records)}
+                if not size_bucket:
+                    size_buckets.add_single(file_record)
+                    continue
+            size_bucket[path] = file_record
+            size_buckets.set_bucket(size, size_bucket)
+            # Every file of a bucket is sent once when its size first collides, then only each new file
+            hash_dispatcher.dispatch(size_bucket.values(), self._get_hash_field(size))
+        return scanned_count, size_buckets, reference_records
+
+    def _update_file_index(self, file_record, kept_path, file_hash=None):
+        """
+         @brief Record the outcome of a scanned file in the file index.
+         @param file_record Tuple of (path, size, file key)
+         @param kept_path Path the file is kept at, or None if it was removed
+         @param file_hash Full hash of the file if it was computed
+        """
+        path, size, file_key = file_record
+        if kept_path is None:
+            self.shared_data.remove_indexed_path(path)
+            return
+        # Moved files and duplicates replaced by links have a new inode, so they get a new file key
+        if kept_path != path or self._config.get("DEDUP_MODE", "remove") != "remove":
+            indexed_file = self.shared_data.get_indexed_file(file_key) or dict()
+            self.shared_data.remove_indexed_path(path)
+            try:
+                file_key = self._get_file_key(os.stat(kept_path))
+            except OSError:
+                return
+            self.shared_data.set_indexed_file(file_key, kept_path, size, partial=indexed_file.get("partial"))
+        self.shared_data.set_indexed_file(file_key, kept_path, size, hash=file_hash)
+
+    def _find_duplicates(self):
+        """
+         @brief Scan the base paths and hash the files that may have duplicates. The scan runs in stages: walk the base paths
+                and group the files by size, partially hash large files whose size collides, then fully hash the files that
+                still collide. Hashing starts while the walk is still running, and hashes of unchanged files are taken from
+                the file index instead of being read. The file index is committed in batches during the scan, so a scan that
+                is interrupted can be started again without hashing the same files again
+         @return Tuple of (iterator over the (path, size, file key) tuples of the files without duplicates sorted by path,
+                 list of ((path, size, file key), hash) tuples of the fully hashed files sorted by path, set of the paths
+                 kept by previous runs)
+        """
+        self._metrics.start_server()
+        print(f"Scanning {len(self._config.get('BASE_PATH'))} base paths with {self._config.get('HASH_WORKERS') or os.cpu_count()} {self._config.get('HASH_EXECUTOR', 'process')} workers")
+        pool = self._create_pool()
+        hash_dispatcher = self._create_hash_dispatcher(pool)
+        scanned_count, size_buckets, reference_records = self._scan_and_dispatch(hash_dispatcher)
+        reference_paths = set(reference_records)
+        print(f"Scanned {scanned_count} files, {len(reference_paths)} indexed files share their size")
+
+        partial_hashes = hash_dispatcher.get_hashes("partial")
+        partial_buckets, unique_files = dict(), list()
+        for size, size_bucket in size_buckets.get_buckets().items():
+            if len(size_bucket) == 1:
+                unique_files.extend(size_bucket.values())
+            elif self._get_hash_field(size) == "partial":
+                for file_record in size_bucket.values():
+                    if file_record in partial_hashes:
+                        partial_buckets.setdefault((size, partial_hashes[file_record]), []).append(file_record)
+        hash_candidates = list()
+        for file_records in partial_buckets.values():
+            if len(file_records) == 1:
+                unique_files.append(file_records[0])
+            else:
+                hash_dispatcher.dispatch(file_records, "hash")
+                hash_candidates.extend(file_records)
+        file_hashes = hash_dispatcher.get_hashes("hash")
+        pool.close()
+        pool.join()
+        for size, size_bucket in size_buckets.get_buckets().items():
+            if len(size_bucket) > 1 and self._get_hash_field(size) == "hash":
+                hash_candidates.extend(size_bucket.values())
+        # Sort by path so the same tree always gives the same result, whatever order the walk and the workers finish in
+        hashed_files = sorted((file_record, file_hashes[file_record]) for file_record in hash_candidates if file_record in file_hashes)
+        unique_files.sort()
+        # The files whose size no other file has are read back from disk as they are needed
+        unique_files = heapq.merge(size_buckets.iter_single_records(self._config.get("SCAN_RUN_ROWS", 1000000)), unique_files)
+        return unique_files, hashed_files, reference_paths
+
+    def _close(self, prune=True):
+        """
+         @brief Prune the file index if PRUNE_CACHE is set and close the index, the executor and the logs.
+         @param prune False to skip the pruning, when only a few known files were touched
+        """
+        if prune and self._config.get("PRUNE_CACHE", True):
+            self._prune_file_index()
+        self.shared_data.close()
+        self._action_executor.close()
+        self._log_writer.close()
+        self._metrics.report(force=True)
+        self._metrics.close()
+
+    def _print_totals(self):
+        print(f"Removed {self.shared_data.get_total_removal_count()} files, free {self.shared_data.get_total_removal_size()} GB")
+        print(f"Moved {self.shared_data.get_total_moved_count()} files, free {self.shared_data.get_total_moved_size()} GB")
+        if self._config.get("DEDUP_MODE", "remove") != "remove":
+            print(f"Linked {self.shared_data.get_total_linked_count()} files, free {self.shared_data.get_total_linked_size()} GB")
+
+    def _verify_duplicates(self, hashed_files, reference_paths):
+        """
+         @brief Compare every duplicate to the file that will be kept in its place, before anything is removed. The
+                keepers are the ones run picks, so the comparisons can all run at once on the verifier pool
+         @param hashed_files List of ((path, size, file key), hash) tuples
+         @param reference_paths Set of the paths kept by previous runs
+         @return Set of the duplicate paths identical to their keeper, or None when VERIFY_DUPLICATES is off
+        """
+        if self._verifier is None:
+            return None
+        file_pairs = [(group["keeper"][0], path) for group in self._planner.build_groups(hashed_files, reference_paths) for path, file_key in group["duplicates"]]
+        with self._metrics.stage("verify"):
+            verified_paths = self._verifier.verify_pairs(file_pairs)
+        print(f"Verified {len(verified_paths)} of {len(file_pairs)} duplicates byte by byte")
+        return verified_paths
+
+    def run(self, move_file=True):
+        """
+         @brief Scan directories and remove duplicated files right away. The file of each group that comes first in the
+                KEEPER_POLICY is kept
+         @param move_file Move unique files into DEST_PATH
+        """
+        self._dedup_scanned_files(move_file)
+        self._close()
+        self._print_totals()
+
+    def _dedup_scanned_files(self, move_file):
+        """
+         @brief Scan directories and remove or keep every scanned file, leaving the file index open. This is called from run and watch
+         @param move_file Move unique files into DEST_PATH
+        """
+        unique_files, hashed_files, reference_paths = self._find_duplicates()
+        hashed_files.sort(key=lambda hashed_file: self._planner.get_keeper_key(hashed_file[0]))
+        verified_paths = self._verify_duplicates(hashed_files, reference_paths)
+
+        with self._metrics.stage("act"):
+            # Files kept by a previous run are registered first so they are never removed in favour of a scanned copy
+            keeper_inodes = dict()
+            for file_record, file_hash in hashed_files:
+                if file_record[0] in reference_paths:
+                    self.shared_data.add_file_digest(file_record[1], file_hash, file_record[0])
+                    keeper_inodes.setdefault((file_record[1], file_hash), self._planner.get_inode(file_record[2]))
+            for file_record in unique_files:
+                if file_record[0] not in reference_paths:
+                    self._update_file_index(file_record, self._keep_unique_file(file_record[0], file_record[1], None, move_file))
+                    self._metrics.report()
+            for file_record, file_hash in hashed_files:
+                if file_record[0] not in reference_paths:
+                    # A path already hardlinked to its keeper frees nothing, it is left as it is
+                    file_inode = self._planner.get_inode(file_record[2])
+                    if keeper_inodes.get((file_record[1], file_hash)) == file_inode:
+                        self._update_file_index(file_record, file_record[0], file_hash)
+                        continue
+                    keeper_inodes.setdefault((file_record[1], file_hash), file_inode)
+                    kept_path = self.remove_duplicate_file(file_record[0], move_file, file_record[1], file_hash,
+                                                           verified_paths is None or file_record[0] in verified_paths)
+                    self._update_file_index(file_record, kept_path, file_hash)
+                    self._metrics.report()
+
+    def plan(self):
+        """
+         @brief Scan directories and write the duplicate groups to the plan file without touching any file. Hashes are
+                stored in the file index, so planning again after small changes only reads the new and modified files
+        """
+        unique_files, hashed_files, reference_paths = self._find_duplicates()
+        plan_path = self._planner.get_plan_path()
+        with self._metrics.stage("plan"):
+            groups = self._planner.build_groups(hashed_files, reference_paths)
+            duplicate_count, reclaimable_size = self._planner.write_plan(groups, plan_path)
+        print(f"Planned {duplicate_count} duplicates in {plan_path}, {reclaimable_size / pow(1024, 3)} GB reclaimable")
+        if self._config.get("NEAR_DUPLICATES", False):
+            # Exact duplicates are already planned, only their keepers are compared to the other images
+            duplicate_paths = set(path for group in groups for path, file_key in group["duplicates"])
+            file_records = (file_record for file_record in itertools.chain(unique_files, (file_record for file_record, file_hash in hashed_files))
+                            if file_record[0] not in duplicate_paths)
+            near_duplicate_path = self._planner.get_near_duplicate_path()
+            with self._metrics.stage("near_duplicates"):
+                near_duplicate_count, near_duplicate_size = self._planner.write_plan(self._find_near_duplicates(file_records), near_duplicate_path)
+            print(f"Found {near_duplicate_count} near duplicate images in {near_duplicate_path}, {near_duplicate_size / pow(1024, 3)} GB")
+        self._close()
+
+    def _get_node_name(self):
+        """
+         @brief Get the name of this node in index shards and node plans.
+         @return NODE_NAME, or the host name by default
+        """
+        return self._config.get("NODE_NAME", socket.gethostname())
+
+    def _add_shard_hashes(self, hash_dispatcher, shard_writer):
+        """
+         @brief Wait for the files dispatched for a shard and add their hashes to it.
+         @param hash_dispatcher HashDispatcher the files were sent to
+         @param shard_writer ShardWriter of the shard
+        """
+        for file_record, file_hash in hash_dispatcher.get_hashes("hash").items():
+            shard_writer.add(file_record, file_hash)
+
+    def write_shard(self):
+        """
+         @brief Scan directories, fully hash every file and write them to the index shard of this node, without touching
+                any file. Unlike plan, files whose size is unique here are hashed too, as another node may have a copy.
+                Files are handed to a new dispatcher every SHARD_RUN_ROWS files, so memory stays bounded on large trees
+        """
+        node_name = self._get_node_name()
+        shard_path = self._config.get("SHARD_PATH", f"{self._config.get_root_dir()}shards/{node_name}.shard.gz")
+        run_rows = self._config.get("SHARD_RUN_ROWS", 1000000)
+        self._metrics.start_server()
+        print(f"Writing the shard of {node_name} from {len(self._config.get('BASE_PATH'))} base paths")
+        pool = self._create_pool()
+        shard_writer = ShardWriter(shard_path, node_name, run_rows)
+        hash_dispatcher, dispatched_count = self._create_hash_dispatcher(pool), 0
+        for file_record in self.walk_files():
+            self._metrics.add("scanned_files")
+            self._metrics.add("scanned_bytes", file_record[1])
+            self._metrics.report()
+            hash_dispatcher.dispatch([file_record], "hash")
+            dispatched_count += 1
+            if dispatched_count >= run_rows:
+                self._add_shard_hashes(hash_dispatcher, shard_writer)
+                hash_dispatcher, dispatched_count = self._create_hash_dispatcher(pool), 0
+        self._add_shard_hashes(hash_dispatcher, shard_writer)
+        pool.close()
+        pool.join()
+        with self._metrics.stage("shard"):
+            file_count = shard_writer.close()
+        print(f"Wrote {file_count} files of {node_name} to {shard_path}")
+        self._close()
+
+    def fingerprint_image_batch(self, file_paths):
+        """
+         @brief Compute the perceptual fingerprints of a batch of images. Runs in the worker pool
+         @param file_paths List of image paths
+         @return Dictionary mapping the path of each readable image to its fingerprint
+        """
+        if self._perceptual_hasher is None:
+            self._perceptual_hasher = PerceptualHasher()
+        return self._perceptual_hasher.get_fingerprints(file_paths)
+
+    def _get_fingerprints(self, image_records):
+        """
+         @brief Get the perceptual fingerprints of images, from the file index for unchanged images and from the worker
+                pool, in batches of BATCH_SIZE, for the others. New fingerprints are stored in the file index
+         @param image_records List of (path, size, file key) tuples
+         @return Dictionary mapping a (path, size, file key) tuple to its fingerprint. Unreadable images are left out
+        """
+        fingerprints, missing_records = dict(), dict()
+        for file_record in image_records:
+            indexed_file = self.shared_data.get_indexed_file(file_record[2])
+            if indexed_file and indexed_file.get("fingerprint"):
+                fingerprints[file_record] = indexed_file["fingerprint"]
+                self._metrics.add("cache_hits")
+            else:
+                missing_records[file_record[0]] = file_record
+                self._metrics.add("cache_misses")
+        batch_size = self._config.get("BATCH_SIZE", 256)
+        missing_paths = list(missing_records)
+        pool = self._create_pool()
+        for batch_fingerprints in pool.imap_unordered(fingerprint_image_batch, [missing_paths[i:i + batch_size] for i in range(0, len(missing_paths), batch_size)]):
+            for path, fingerprint in batch_fingerprints.items():
+                file_record = missing_records[path]
+                fingerprints[file_record] = fingerprint
+                self.shared_data.set_indexed_file(file_record[2], path, file_record[1], fingerprint=fingerprint)
+            self._metrics.add("fingerprinted_images", len(batch_fingerprints))
+            self._metrics.report()
+        pool.close()
+        pool.join()
+        print(f"Reused {len(image_records) - len(missing_paths)} of {len(image_records)} indexed fingerprints")
+        return fingerprints
+
+    def _find_near_duplicates(self, file_records):
+        """
+         @brief Group images that look the same but are not byte identical, e.g. re-encoded or resized copies. Images are
+                taken largest first, by pixels then bytes, and each is looked up in a multi-index hash of the pHashes of
+                the group keepers, so an image is compared to a few keepers instead of every other image. An image is a near duplicate when both its pHash and its dHash
+                are within NEAR_DUPLICATE_DISTANCE bits of the keeper's
+         @param file_records Iterable of (path, size, file key) tuples, images are picked by their extension
+         @return List of groups, each a dictionary with "keeper" as a (path, file key) pair and "duplicates" as a list of
+                 (path, file key, size, pHash distance) tuples. The groups are only reported, nothing is removed
+        """
+        if not PerceptualHasher.is_available():
+            print("Near duplicate detection needs numpy and Pillow, skip it")
+            return list()
+        image_records = [file_record for file_record in file_records if self._path_filter.get_extension(os.path.basename(file_record[0])) in IMAGE_EXTENSIONS]
+        fingerprints = self._get_fingerprints(image_records)
+        max_distance = self._config.get("NEAR_DUPLICATE_DISTANCE", 6)
+        keeper_index, groups = MultiIndexHash(max_distance), list()
+        split_fingerprints = {file_record: split_fingerprint(fingerprint) for file_record, fingerprint in fingerprints.items()}
+        for file_record in sorted(split_fingerprints, key=lambda file_record: (-split_fingerprints[file_record][2], -file_record[1], file_record[0])):
+            dhash, phash, pixel_count = split_fingerprints[file_record]
+            for distance, group in keeper_index.search(phash):
+                if (group["dhash"] ^ dhash).bit_count() <= max_distance:
+                    group["duplicates"].append([file_record[0], file_record[2], file_record[1], distance])
+                    break
+            else:
+                group = {"keeper": [file_record[0], file_record[2]], "dhash": dhash, "duplicates": list()}
+                keeper_index.add(phash, group)
+                groups.append(group)
+        return [{"keeper": group["keeper"], "duplicates": group["duplicates"]} for group in groups if group["duplicates"]]
 
-    def construct_dir_paths(self, base_path):
+    def _apply_duplicate(self, keeper, duplicate, keeper_node=None):
         """
-         @brief Construct list of directories to search for. This is recursive so we don't have to worry about recursion
-         @param base_path base path to start
+         @brief Remove or link a planned duplicate, as set by DEDUP_MODE. Nothing is done if the duplicate or its keeper
+                changed since the plan was made, or if VERIFY_DUPLICATES is set and their bytes differ. A keeper on another
+                node can't be checked from here, so its duplicates are skipped unless TRUST_REMOTE_KEEPERS is set
+         @param keeper (path, file key) pair of the keeper
+         @param duplicate (path, file key) pair of the duplicate
+         @param keeper_node Node holding the keeper, for plans merged from index shards
+         @return "removed" or "linked" if the action was done, None otherwise
         """
-        if base_path != self._config.get("DEST_PATH"):
-            self.dir_paths.append(base_path)
+        (keeper_path, keeper_key), (path, file_key) = keeper, duplicate
+        dedup_mode = self._config.get("DEDUP_MODE", "remove")
         try:
-            dir_list = os.listdir(base_path)
-            for name in dir_list:
-                path = base_path + name
-                # Construct the directory paths for the given path.
-                if os.path.isdir(path):
-                    self.construct_dir_paths(path + "/")
-        except:
-            print(f"{base_path} - Access denied, skip")
+            if keeper_node is not None and keeper_node != self._get_node_name():
+                # Removing the duplicate loses the content if the keeper was deleted or changed on its node since the shards were written
+                if not self._config.get("TRUST_REMOTE_KEEPERS", False):
+                    logger.warning(f"{path} is kept on {keeper_node}, which can't be checked from here, skip")
+                    return None
+                # Only the duplicate can be checked, so it is only removed on the strength of its hash
+                if dedup_mode != "remove" or self._verifier is not None:
+                    logger.warning(f"{path} is kept on {keeper_node}, it can only be removed without verification, skip")
+                    return None
+                if self._get_file_key(os.stat(path)) != file_key:
+                    logger.warning(f"{path} changed since the plan was made, skip")
+                    return None
+                self._action_executor.remove(path)
+                return "removed"
+            if self._get_file_key(os.stat(path)) != file_key or self._get_file_key(os.stat(keeper_path)) != keeper_key:
+                logger.warning(f"{path} or {keeper_path} changed since the plan was made, skip")
+                return None
+            # Paths already hardlinked to the keeper free nothing, plans made before they were left out may list them
+            if os.path.samefile(keeper_path, path):
+                return None
+            if self._verifier is not None and not self._verifier.is_identical(keeper_path, path):
+                logger.warning(f"{path} has the hash of {keeper_path} but different bytes, skip")
+                return None
+            if dedup_mode == "remove":
+                self._action_executor.remove(path)
+                return "removed"
+            self._action_executor.link(path, keeper_path, dedup_mode)
+            return "linked"
+        except OSError as e:
+            logger.error(f"Error: {path} cannot be deduplicated against {keeper_path}, {e}")
+            return None
+
+    def _apply_device_groups(self, device_groups):
+        """
+         @brief Apply the planned duplicates of one device, in plan order. Runs in a thread per device
+         @param device_groups List of (group, duplicate) tuples
+         @return List of (group, duplicate, outcome) tuples, see _apply_duplicate for the outcome
+        """
+        return [(group, duplicate, self._apply_duplicate(group["keeper"], duplicate, group.get("keeper_node"))) for group, duplicate in device_groups]
+
+    def apply_plan(self):
+        """
+         @brief Remove or link the duplicates of the plan file. Devices are processed in parallel, one thread each, while the
+                logs, totals and file index are updated here as each device finishes
+        """
+        plan_path = self._planner.get_plan_path()
+        if not os.path.isfile(plan_path):
+            print(f"No plan to apply at {plan_path}, run with RUN_MODE \"plan\" first")
+            self.shared_data.close()
             return
-        # print(dir_list)
-        # Recursively construct the directory paths for each directory.
+        device_groups = dict()
+        for group in self._planner.read_plan(plan_path):
+            for duplicate in group["duplicates"]:
+                # The file key starts with the device of the file
+                device_groups.setdefault(duplicate[1].split(":", 1)[0], []).append((group, duplicate))
+        self._metrics.start_server()
+        print(f"Applying {plan_path} on {len(device_groups)} devices")
+        with self._metrics.stage("act"), ThreadPoolExecutor(max_workers=max(len(device_groups), 1)) as executor:
+            for future in as_completed([executor.submit(self._apply_device_groups, groups) for groups in device_groups.values()]):
+                for group, (path, file_key), outcome in future.result():
+                    file_size = group["size"]
+                    if outcome == "removed":
+                        self._record_removed(path, file_size)
+                        self._update_file_index((path, file_size, file_key), None)
+                    elif outcome == "linked":
+                        self._record_linked(path, group["keeper"][0], file_size)
+                        self._update_file_index((path, file_size, file_key), path, group["hash"])
+                self._metrics.report()
+        # The whole index is not walked again, only the planned files were touched
+        self._close(prune=False)
+        self._print_totals()
+
+
+    def _is_indexed_as_is(self, file_record):
+        """
+         @brief Check whether a file is indexed at its path and did not change since.
+         @param file_record Tuple of (path, size, file key)
+         @return True if the file needs no new look
+        """
+        indexed_file = self.shared_data.get_indexed_path(file_record[0])
+        return indexed_file is not None and indexed_file["file_key"] == file_record[2]
 
-    def loop_path(self, base_path, move_file=True):
+    def _get_indexed_hash(self, file_key):
         """
-         @brief Loop through directory and check for files with same extension. This is used for cleaning up files that are in the same directory as the test file
-         @param base_path path to the directory to
+         @brief Get the full hash of a file from the file index, if it was computed with HASH_ALGORITHM.
+         @param file_key Key of the file as built by _get_file_key
+         @return Hash of the file, or None if it is not indexed
+        """
+        indexed_file = self.shared_data.get_indexed_file(file_key)
+        if indexed_file and indexed_file.get("hash") and self._hasher.is_own_digest(indexed_file["hash"]):
+            return indexed_file["hash"]
+        return None
+
+    def _dedup_changed_file(self, file_path, move_file):
+        """
+         @brief Remove or keep a file that was created or changed while watching. Only the file and the indexed files of
+                its size whose hash is not indexed yet are read
+         @param file_path Path to the file
+         @param move_file Move the file into DEST_PATH when it is not a duplicate
+         @return False if the file was modified less than DEBOUNCE_SECONDS ago and should be looked at later, True otherwise
         """
         try:
-            dir_list = os.listdir(base_path)
-            # Remove duplicate files in the directory list.
-            for name in dir_list:
-                path = base_path + name
-                # Remove duplicate file if it s a file extension.
-                if os.path.isfile(path):
-                    file_extension = pathlib.Path(path).suffix[1:]
-                    # Remove duplicate files if they are already in the file_extension list.
-                    if file_extension.lower() in self._config.get("FILE_EXTENSIONS"):
-                        # os.system(f"sudo mount -o remount,rw '{path}'")
-                        self.remove_duplicate_file(path, move_file)
-        except Exception as e:
-            print(e)
-
-    def run(self):
-        """
-         @brief Scan directories and remove files that are no longer in the cache. This is run in a separate thread
-        """
-        # Construct the directory paths for the base_path.
+            file_stats = os.stat(file_path, follow_symlinks=False)
+        except OSError:
+            return True
+        if (not stat.S_ISREG(file_stats.st_mode) or not self._path_filter.is_target_file(os.path.basename(file_path), file_path)
+                or not self._path_filter.is_target_size(file_stats.st_size)):
+            return True
+        if time.time() - file_stats.st_mtime < self._config.get("DEBOUNCE_SECONDS", 2):
+            return False
+        file_record = (file_path, file_stats.st_size, self._get_file_key(file_stats))
+        if self._is_indexed_as_is(file_record):
+            return True
+        size_references = self._get_size_references(file_stats.st_size, file_path, dict())
+        if not size_references:
+            self._update_file_index(file_record, self._keep_unique_file(file_path, file_stats.st_size, None, move_file))
+            return True
+        try:
+            file_hash = self._get_indexed_hash(file_record[2]) or self._get_file_hash(file_path)
+        except OSError as e:
+            logger.error(e)
+            return True
+        keeper_path = None
+        for path, size, file_key in size_references:
+            reference_hash = self._get_indexed_hash(file_key)
+            if reference_hash is None:
+                try:
+                    reference_hash = self._get_file_hash(path)
+                except OSError as e:
+                    logger.error(e)
+                    continue
+                self.shared_data.set_indexed_file(file_key, path, size, hash=reference_hash)
+            if reference_hash == file_hash:
+                keeper_path = path
+                break
+        if keeper_path is None:
+            kept_path = self._keep_unique_file(file_path, file_stats.st_size, file_hash, move_file)
+        else:
+            is_verified = self._verifier is None or self._verifier.is_identical(keeper_path, file_path)
+            kept_path = self._dedup_file(file_path, file_stats.st_size, keeper_path, is_verified)
+        self._update_file_index(file_record, kept_path, file_hash)
+        return True
+
+    def _start_watcher(self):
+        """
+         @brief Watch the base paths with inotify. Network mounts, base paths of a WATCH_MODE "rescan" and base paths inotify
+                can't watch, e.g. past fs.inotify.max_user_watches, are rescanned instead
+         @return Tuple of (InotifyWatcher or None, list of the watched base paths, list of the rescanned base paths)
+        """
+        watched_paths, rescanned_paths = list(), list()
         for base_path in self._config.get("BASE_PATH"):
-            self.construct_dir_paths(base_path)
-        self.dir_paths = list(set(self.dir_paths))
-        print(f"Scanning {len(self.dir_paths)} directories with {os.cpu_count()} CPUs")
-        pool = Pool()
-        pool.map(self.loop_path, self.dir_paths)
+            if self._path_filter.is_excluded_dir(base_path):
+                continue
+            if self._config.get("WATCH_MODE", "auto") == "rescan" or is_network_mount(base_path):
+                rescanned_paths.append(base_path)
+            else:
+                watched_paths.append(base_path)
+        if not watched_paths:
+            return None, watched_paths, rescanned_paths
+        watcher = None
+        try:
+            watcher = InotifyWatcher()
+            for base_path in watched_paths:
+                watcher.add_tree(base_path, self._path_filter.is_excluded_dir)
+        except OSError as e:
+            print(f"inotify cannot watch the base paths, rescan them instead, {e}")
+            if watcher is not None:
+                watcher.close()
+            return None, list(), rescanned_paths + watched_paths
+        return watcher, watched_paths, rescanned_paths
+
+    def watch(self, move_file=True):
+        """
+         @brief Run as a daemon. The base paths are scanned once like run does, then the files created, written or moved
+                into them are deduplicated as they appear, against the file index, so the cost follows the rate of change.
+                A file is only looked at once it had no event for DEBOUNCE_SECONDS, so a file being written is hashed once.
+                Base paths inotify can't watch are walked every RESCAN_SECONDS, hashing only the files that are new or
+                changed since they were indexed. Stops on SIGINT or SIGTERM
+         @param move_file Move unique files into DEST_PATH
+        """
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        debounce_seconds = self._config.get("DEBOUNCE_SECONDS", 2)
+        rescan_seconds = self._config.get("RESCAN_SECONDS", 300)
+        # The watch starts before the first scan, so files written during the scan are queued instead of missed
+        watcher, watched_paths, rescanned_paths = self._start_watcher()
+        if not watched_paths and not rescanned_paths:
+            print("Nothing to watch, every BASE_PATH is DEST_PATH or excluded by EXCLUDE_PATTERNS")
+            self._close()
+            return
+        pending_paths = dict()
+        try:
+            self._dedup_scanned_files(move_file)
+            self.shared_data.commit_file_index()
+            self._log_writer.flush()
+            print(f"Watching {len(watched_paths)} base paths with inotify, rescanning {len(rescanned_paths)} every {rescan_seconds} seconds")
+            next_rescan_time = time.monotonic() + rescan_seconds
+            while True:
+                if pending_paths:
+                    timeout = debounce_seconds
+                elif rescanned_paths:
+                    timeout = max(next_rescan_time - time.monotonic(), 0)
+                else:
+                    timeout = None
+                if watcher is not None:
+                    changed_paths, is_overflowed = watcher.read_events(timeout, self._path_filter.is_excluded_dir)
+                else:
+                    time.sleep(timeout)
+                    changed_paths, is_overflowed = list(), False
+                now = time.monotonic()
+                for path in changed_paths:
+                    pending_paths[path] = now
+                # Events lost to a queue overflow are recovered by rescanning the watched paths too
+                if is_overflowed or (rescanned_paths and now >= next_rescan_time):
+                    for file_record in self.walk_files(watched_paths + rescanned_paths if is_overflowed else rescanned_paths):
+                        if not self._is_indexed_as_is(file_record):
+                            pending_paths.setdefault(file_record[0], now)
+                    if rescanned_paths and now >= next_rescan_time:
+                        next_rescan_time = now + rescan_seconds
+                ready_paths = sorted(path for path, event_time in pending_paths.items() if now - event_time >= debounce_seconds)
+                for path in ready_paths:
+                    del pending_paths[path]
+                    if not self._dedup_changed_file(path, move_file):
+                        pending_paths[path] = now
+                if ready_paths:
+                    self.shared_data.commit_file_index()
+                    self._log_writer.flush()
+                self._metrics.set_gauge("pending_files", len(pending_paths))
+                self._metrics.report()
+        except KeyboardInterrupt:
+            print("Stop watching")
+        finally:
+            if watcher is not None:
+                watcher.close()
+            self._close()
+            self._print_totals()
+
+
+# Each hashing worker gets its own FileManager, so tasks only carry the file records
+_worker_file_manager = None
+
+
+def init_hash_worker(config):
+    """
+     @brief Initialize a hashing worker of the pool. Runs once in each worker
+     @param config A config object that contains the configuration for the task
+    """
+    global _worker_file_manager
+    init_logging(config)
+    _worker_file_manager = FileManager(None, config)
+
+
+def hash_file_batch(hash_field, file_records):
+    """
+     @brief Hash a batch of file records with the FileManager of the current worker.
+     @param hash_field Kind of hash to compute, "partial" or "hash"
+     @param file_records List of (path, size, file key) tuples
+     @return Tuple of (list of ((path, size, file key), hash) tuples, number of bytes read, seconds spent)
+    """
+    return _worker_file_manager.hash_file_batch(hash_field, file_records)
+
+
+def init_logging(config):
+    """
+     @brief Send the log messages to the standard output as plain lines, from the LOG_LEVEL level up.
+     @param config A config object that contains the configuration for the task
+    """
+    logging.basicConfig(level=getattr(logging, str(config.get("LOG_LEVEL", "INFO")).upper(), logging.INFO), format="%(message)s", stream=sys.stdout)
 
-        self.shared_data.write_cache("hash-dict.json", self.shared_data.get_hash_dict())
-        self.shared_data.write_cache("size-dict.json", self.shared_data.get_size_dict())
 
-        print(f"Removed {shared_data.get_total_removal_count()} files, free {shared_data.get_total_removal_size()} GB")
-        print(f"Moved {shared_data.get_total_moved_count()} files, free {shared_data.get_total_moved_size()} GB")
+def fingerprint_image_batch(file_paths):
+    """
+     @brief Compute the perceptual fingerprints of a batch of images with the FileManager of the current worker.
+     @param file_paths List of image paths
+     @return Dictionary mapping the path of each readable image to its fingerprint
+    """
+    return _worker_file_manager.fingerprint_image_batch(file_paths)
 
 
 # This is the main function that is called from the main module.
 if __name__ == "__main__":
-    ROOT_DIR = os.path.dirname(os.path.abspath(__file__)).replace("\\", "/") + "/"
     OS_NAME = sys.platform
     config = Config()
+    # The log, cache, plan and shards directories live in ROOT_DIR, the directory of this script by default
+    ROOT_DIR = config.get("ROOT_DIR", os.path.dirname(os.path.abspath(__file__))).replace("\\", "/").rstrip("/") + "/"
     config.set_root_dir(ROOT_DIR)
     config.set_os_name(OS_NAME)
+    init_logging(config)
     shared_data = SharedData(config)
     file_manager = FileManager(shared_data, config)
-    file_manager.run()
+    # RUN_MODE "run" removes duplicates as they are found, "plan" only writes them to PLAN_PATH, "apply" acts on that plan
+    # and "watch" keeps running and removes duplicates as they are written. "shard" writes the index shard of this node,
+    # shard_merger.py merges the shards of several nodes into a plan per node
+    run_mode = sys.argv[1] if len(sys.argv) > 1 else config.get("RUN_MODE", "run")
+    if run_mode == "plan":
+        file_manager.plan()
+    elif run_mode == "apply":
+        file_manager.apply_plan()
+    elif run_mode == "shard":
+        file_manager.write_shard()
+    elif run_mode == "watch":
+        file_manager.watch(config.get("MOVE_UNIQUE_FILES", True))
+    else:
+        file_manager.run(config.get("MOVE_UNIQUE_FILES", True))
@@ -0,0 +1,53 @@
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("file_manager")
+
+
+class FileVerifier:
+    def __init__(self, chunk_size, workers):
+        """
+         @brief Initialize the verifier. It compares files byte by byte before a duplicate is removed or linked, so a hash
+                collision can never cost a file, whatever hash algorithm found the duplicate
+         @param chunk_size Bytes read from each file at a time
+         @param workers Number of comparisons run at once, kept low so the disks are not thrashed by random reads
+        """
+        self._chunk_size = chunk_size
+        self._workers = workers
+
+    def is_identical(self, keeper_path, file_path):
+        """
+         @brief Compare two files in lockstep chunks, stopping at the first chunk that differs.
+         @param keeper_path Path of the kept file
+         @param file_path Path of the duplicate
+         @return True if both files have the same bytes, False if they differ or one of them can't be read
+        """
+        try:
+            with open(keeper_path, "rb", buffering=0) as keeper_file, open(file_path, "rb", buffering=0) as file:
+                keeper_stats, file_stats = os.fstat(keeper_file.fileno()), os.fstat(file.fileno())
+                if keeper_stats.st_size != file_stats.st_size:
+                    return False
+                if (keeper_stats.st_dev, keeper_stats.st_ino) == (file_stats.st_dev, file_stats.st_ino):
+                    return True
+                keeper_buffer, buffer = memoryview(bytearray(self._chunk_size)), memoryview(bytearray(self._chunk_size))
+                while True:
+                    keeper_read, read = keeper_file.readinto(keeper_buffer), file.readinto(buffer)
+                    # Both files have the same size, so short reads of regular files line up
+                    if keeper_read != read or keeper_buffer[:keeper_read] != buffer[:read]:
+                        return False
+                    if not read:
+                        return True
+        except OSError as e:
+            logger.error(f"Error: {file_path} cannot be compared to {keeper_path}, {e}")
+            return False
+
+    def verify_pairs(self, file_pairs):
+        """
+         @brief Compare many pairs of files on a bounded thread pool. Reading releases the GIL, so the comparisons overlap
+         @param file_pairs List of (keeper path, duplicate path) tuples
+         @return Set of the duplicate paths that are identical to their keeper
+        """
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            results = executor.map(lambda file_pair: self.is_identical(*file_pair), file_pairs)
+            return set(file_pair[1] for file_pair, is_identical in zip(file_pairs, results) if is_identical)
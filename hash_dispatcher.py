@@ -0,0 +1,87 @@
+class HashDispatcher:
+    def __init__(self, hash_function, pool, shared_data, batch_size, batch_bytes, hashers, metrics):
+        """
+         @brief Initialize the dispatcher. It sends file records to the worker pool in batches while the directory walk is
+                still running. Batches are small enough that idle workers pick up the next batch instead of waiting on one
+                worker busy with a large directory or a few large files
+         @param hash_function Pool function taking a kind of hash and a list of file records
+         @param pool Worker pool
+         @param shared_data SharedData holding the file index
+         @param batch_size Maximum number of files sent to a worker at once
+         @param batch_bytes Maximum number of bytes fully hashed by a worker at once, a larger file gets a batch of its own
+         @param hashers Dictionary mapping a kind of hash to the Hasher computing it, indexed hashes of another algorithm are not reused
+         @param metrics Metrics counting the cache hits and the hashed files, bytes and batches
+        """
+        self._hash_function = hash_function
+        self._pool = pool
+        self.shared_data = shared_data
+        self._batch_size = batch_size
+        self._batch_bytes = batch_bytes
+        self._hashers = hashers
+        self._metrics = metrics
+        self._batches = {"partial": list(), "hash": list()}
+        self._batch_sizes = {"partial": 0, "hash": 0}
+        self._pending = {"partial": list(), "hash": list()}
+        self._hashes = {"partial": dict(), "hash": dict()}
+        self._reused_count = {"partial": 0, "hash": 0}
+
+    def dispatch(self, file_records, hash_field):
+        """
+         @brief Queue file records for hashing. Hashes stored in the file index are reused instead of being computed. Callers
+                dispatch each file at most once per kind of hash
+         @param file_records Iterable of (path, size, file key) tuples
+         @param hash_field Kind of hash to compute, "partial" or "hash"
+        """
+        for file_record in file_records:
+            indexed_file = self.shared_data.get_indexed_file(file_record[2])
+            if indexed_file and indexed_file.get(hash_field) and self._hashers[hash_field].is_own_digest(indexed_file[hash_field]):
+                self._hashes[hash_field][file_record] = indexed_file[hash_field]
+                self._reused_count[hash_field] += 1
+                self._metrics.add("cache_hits")
+                continue
+            self._metrics.add("cache_misses")
+            self._batches[hash_field].append(file_record)
+            if hash_field == "hash":
+                self._batch_sizes[hash_field] += file_record[1]
+            if len(self._batches[hash_field]) >= self._batch_size or self._batch_sizes[hash_field] >= self._batch_bytes:
+                self._send_batch(hash_field)
+
+    def _send_batch(self, hash_field):
+        """
+         @brief Send the queued file records of a kind of hash to the worker pool.
+         @param hash_field Kind of hash to compute, "partial" or "hash"
+        """
+        if self._batches[hash_field]:
+            self._pending[hash_field].append(self._pool.apply_async(self._hash_function, (hash_field, self._batches[hash_field]),
+                                                                    callback=lambda result: self._count_batch(hash_field, result)))
+            self._metrics.add("dispatched_batches")
+            self._batches[hash_field] = list()
+            self._batch_sizes[hash_field] = 0
+
+    def _count_batch(self, hash_field, result):
+        """
+         @brief Count a finished batch in the metrics. Runs in the result thread of the pool as soon as the batch is done
+         @param hash_field Kind of hash computed, "partial" or "hash"
+         @param result Tuple returned by the hash function
+        """
+        hashed_files, read_size, seconds = result
+        self._metrics.add("hashed_batches")
+        self._metrics.add("hashed_files", len(hashed_files))
+        self._metrics.add("hashed_bytes", read_size)
+        self._metrics.add_stage_time("partial_hash" if hash_field == "partial" else "full_hash", seconds)
+
+    def get_hashes(self, hash_field):
+        """
+         @brief Wait for every dispatched file of a kind of hash and store the new hashes in the file index.
+         @param hash_field Kind of hash, "partial" or "hash"
+         @return Dictionary mapping a (path, size, file key) tuple to its hash. Unreadable files are left out
+        """
+        self._send_batch(hash_field)
+        for pending_batch in self._pending[hash_field]:
+            for file_record, file_hash in pending_batch.get()[0]:
+                if file_hash is not None:
+                    self._hashes[hash_field][file_record] = file_hash
+                    self.shared_data.set_indexed_file(file_record[2], file_record[0], file_record[1], **{hash_field: file_hash})
+        self._pending[hash_field] = list()
+        print(f"Reused {self._reused_count[hash_field]} of {len(self._hashes[hash_field])} indexed {hash_field} values")
+        return self._hashes[hash_field]
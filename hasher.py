@@ -0,0 +1,86 @@
+import hashlib
+import logging
+import threading
+import multiprocessing
+
+logger = logging.getLogger("file_manager")
+
+# Optional native hash libraries, "pip install xxhash blake3" adds the xxh64, xxh3_64, xxh3_128 and blake3 algorithms,
+# only the hashlib algorithms are available without them
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+FALLBACK_ALGORITHM = "blake2b"
+
+# Algorithms whose fallback was reported already, thread pool workers build their hashers in the same process
+_reported_algorithms = set()
+_reported_lock = threading.Lock()
+
+
+def _get_hash_constructors():
+    """
+     @brief Get the constructors of the available hash algorithms.
+     @return Dictionary mapping an algorithm name to a function returning a new hash object
+    """
+    hash_constructors = {
+        "md5": hashlib.md5,
+        "sha1": hashlib.sha1,
+        "sha256": hashlib.sha256,
+        "blake2b": lambda: hashlib.blake2b(digest_size=32),
+        "blake2s": hashlib.blake2s,
+    }
+    if xxhash is not None:
+        hash_constructors["xxh64"] = xxhash.xxh64
+        hash_constructors["xxh3_64"] = xxhash.xxh3_64
+        hash_constructors["xxh3_128"] = xxhash.xxh3_128
+    if blake3 is not None:
+        hash_constructors["blake3"] = blake3.blake3
+    return hash_constructors
+
+
+class Hasher:
+    def __init__(self, algorithm):
+        """
+         @brief Initialize the hasher. Falls back to blake2b when the algorithm is unknown or its library is not installed
+         @param algorithm Name of the hash algorithm, e.g. "xxh3_128", "blake3", "blake2b" or "md5"
+        """
+        hash_constructors = _get_hash_constructors()
+        if algorithm not in hash_constructors:
+            # Every pool worker builds its own hashers, the fallback is reported once by the parent process
+            with _reported_lock:
+                is_reported = algorithm in _reported_algorithms
+                _reported_algorithms.add(algorithm)
+            if not is_reported and multiprocessing.parent_process() is None:
+                logger.warning(f"Hash algorithm {algorithm} is not available, using {FALLBACK_ALGORITHM}")
+            algorithm = FALLBACK_ALGORITHM
+        self.algorithm = algorithm
+        self._hash_constructor = hash_constructors[algorithm]
+
+    def new(self):
+        """
+         @brief Create a new hash object of the algorithm.
+         @return Hash object with update and hexdigest methods
+        """
+        return self._hash_constructor()
+
+    def get_digest(self, hash_object):
+        """
+         @brief Get the digest of a hash object tagged with the algorithm, so digests of different algorithms never match
+         @param hash_object Hash object created by new
+         @return String of the form algorithm:hexdigest
+        """
+        return f"{self.algorithm}:{hash_object.hexdigest()}"
+
+    def is_own_digest(self, digest):
+        """
+         @brief Check whether a digest was produced by this algorithm. Digests cached with another algorithm have to be recomputed
+         @param digest Digest as returned by get_digest
+         @return True if the digest was produced by this algorithm
+        """
+        return digest.startswith(f"{self.algorithm}:")
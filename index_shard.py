@@ -0,0 +1,109 @@
+import os
+import gzip
+import json
+import heapq
+import tempfile
+
+# Version of the shard format, written in the header line of every shard
+SHARD_FORMAT = 1
+
+
+def _read_run(run_file):
+    """
+     @brief Read back a sorted run written by ShardWriter.
+     @param run_file Temporary file of the run, opened for reading and writing
+     @return Iterator over the [size, hash, path, file key] rows of the run
+    """
+    run_file.seek(0)
+    for line in run_file:
+        yield json.loads(line)
+
+
+class ShardWriter:
+    def __init__(self, shard_path, node_name, run_rows):
+        """
+         @brief Initialize the writer of an index shard. A shard lists every hashed file of a node as [size, hash, path,
+                file key] rows sorted by size, hash and path, so the shards of all nodes can be merged as streams.
+                Rows are sorted in memory in runs of run_rows and the runs are merged into the shard when it is closed,
+                so a node with more files than fit in memory can still write its shard
+         @param shard_path Path of the shard file, gzip compressed JSON Lines
+         @param node_name Name of the node, written in the header line so the merge knows where each file is
+         @param run_rows Maximum number of rows sorted in memory at once
+        """
+        self._shard_path = shard_path
+        self._node_name = node_name
+        self._run_rows = run_rows
+        self._rows = list()
+        self._run_files = list()
+        self._row_count = 0
+        os.makedirs(os.path.dirname(self._shard_path) or ".", exist_ok=True)
+
+    def add(self, file_record, file_hash):
+        """
+         @brief Add a hashed file to the shard.
+         @param file_record Tuple of (path, size, file key)
+         @param file_hash Full hash of the file
+        """
+        path, size, file_key = file_record
+        self._rows.append([size, file_hash, path, file_key])
+        self._row_count += 1
+        if len(self._rows) >= self._run_rows:
+            self._write_run()
+
+    def _write_run(self):
+        """
+         @brief Sort the rows held in memory and write them to a temporary run file, deleted once it is closed.
+        """
+        self._rows.sort()
+        run_file = tempfile.TemporaryFile("w+", encoding="utf-8", dir=os.path.dirname(self._shard_path) or ".")
+        for row in self._rows:
+            run_file.write(json.dumps(row, ensure_ascii=False, separators=(",", ":")) + "\n")
+        self._run_files.append(run_file)
+        self._rows = list()
+
+    def close(self):
+        """
+         @brief Merge the runs and write the shard, replacing the previous shard only once the new one is complete.
+         @return Number of files in the shard
+        """
+        if self._run_files:
+            self._write_run()
+            rows = heapq.merge(*[_read_run(run_file) for run_file in self._run_files])
+        else:
+            rows = sorted(self._rows)
+        header = {"format": SHARD_FORMAT, "node": self._node_name, "files": self._row_count}
+        with gzip.open(self._shard_path + ".tmp", "wt", encoding="utf-8", compresslevel=6) as shard_file:
+            shard_file.write(json.dumps(header, ensure_ascii=False) + "\n")
+            for row in rows:
+                shard_file.write(json.dumps(row, ensure_ascii=False, separators=(",", ":")) + "\n")
+        os.replace(self._shard_path + ".tmp", self._shard_path)
+        for run_file in self._run_files:
+            run_file.close()
+        self._rows, self._run_files = list(), list()
+        return self._row_count
+
+
+def read_shard_header(shard_path):
+    """
+     @brief Read the header line of a shard.
+     @param shard_path Path of the shard file
+     @return Dictionary with "format", "node" and "files"
+    """
+    with gzip.open(shard_path, "rt", encoding="utf-8") as shard_file:
+        header = json.loads(shard_file.readline())
+    if header.get("format") != SHARD_FORMAT:
+        raise ValueError(f"{shard_path} has shard format {header.get('format')}, expected {SHARD_FORMAT}")
+    return header
+
+
+def read_shard(shard_path):
+    """
+     @brief Read the rows of a shard one at a time, so a shard is never held in memory.
+     @param shard_path Path of the shard file
+     @return Iterator over the [size, hash, path, file key] rows, in shard order
+    """
+    with gzip.open(shard_path, "rt", encoding="utf-8") as shard_file:
+        shard_file.readline()
+        for line in shard_file:
+            if line.strip():
+                yield json.loads(line)
@@ -0,0 +1,132 @@
+import os
+import sys
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+# Event masks from linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR | IN_DONT_FOLLOW
+EVENT_HEADER = struct.Struct("iIII")
+
+# File systems whose changes made by other hosts never reach inotify, they are rescanned instead
+NETWORK_FILE_SYSTEMS = {"nfs", "nfs4", "cifs", "smb3", "smbfs", "9p", "afs", "ceph", "glusterfs", "fuse.sshfs", "fuse.rclone", "fuse.s3fs"}
+
+
+def is_network_mount(path):
+    """
+     @brief Check whether a path is on a network file system, from the mount table of Linux.
+     @param path Path of a directory
+     @return True if the closest mount point above the path has a network file system type
+    """
+    try:
+        with open("/proc/mounts", encoding="utf-8") as mounts_file:
+            mounts = [line.split()[1:3] for line in mounts_file]
+    except OSError:
+        return False
+    path = os.path.realpath(path)
+    matching_mounts = [(mount_point, file_system) for mount_point, file_system in mounts
+                       if path == mount_point or path.startswith(mount_point.rstrip("/") + "/")]
+    if not matching_mounts:
+        return False
+    return max(matching_mounts, key=lambda mount: len(mount[0]))[1] in NETWORK_FILE_SYSTEMS
+
+
+class InotifyWatcher:
+    def __init__(self):
+        """
+         @brief Initialize the watcher with inotify through ctypes, so no extra package is needed. Raises OSError where
+                inotify is not available
+        """
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._file_descriptor = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self._file_descriptor < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._watched_dirs = dict()
+
+    def _add_watch(self, dir_path):
+        """
+         @brief Watch a single directory. Raises OSError when the watch limit of fs.inotify.max_user_watches is reached
+         @param dir_path Path of the directory, ending with a "/"
+        """
+        watch_descriptor = self._libc.inotify_add_watch(self._file_descriptor, os.fsencode(dir_path), WATCH_MASK)
+        if watch_descriptor < 0:
+            error_number = ctypes.get_errno()
+            # The directory may be gone or unreadable already, its parent still reports what happens next
+            if error_number in (errno.ENOENT, errno.EACCES, errno.ENOTDIR):
+                return
+            raise OSError(error_number, f"inotify_add_watch failed for {dir_path}")
+        self._watched_dirs[watch_descriptor] = dir_path
+
+    def add_tree(self, dir_path, is_skipped_dir=None):
+        """
+         @brief Watch a directory and every directory below it, without following symbolic links.
+         @param dir_path Path of the directory, ending with a "/"
+         @param is_skipped_dir Function taking the path of a directory, ending with a "/", that returns True if the
+                directory is not watched, with everything below it
+         @return List of the paths of the files already in the tree, which may have been written before the watch started
+        """
+        file_paths, dir_paths = list(), [dir_path]
+        while dir_paths:
+            dir_path = dir_paths.pop()
+            self._add_watch(dir_path)
+            try:
+                with os.scandir(dir_path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            if is_skipped_dir is None or not is_skipped_dir(entry.path + "/"):
+                                dir_paths.append(entry.path + "/")
+                        elif entry.is_file(follow_symlinks=False):
+                            file_paths.append(entry.path)
+            except OSError:
+                pass
+        return file_paths
+
+    def read_events(self, timeout, is_skipped_dir=None):
+        """
+         @brief Wait for events and return the files they are about. New directories are watched as they appear
+         @param timeout Seconds to wait for the first event
+         @param is_skipped_dir Function telling which directories are not watched when they appear, see add_tree
+         @return Tuple of (list of the paths of the created, written or moved in files, True if the kernel queue overflowed
+                 and events were lost)
+        """
+        changed_paths, is_overflowed = list(), False
+        if not select.select([self._file_descriptor], [], [], timeout)[0]:
+            return changed_paths, is_overflowed
+        data = os.read(self._file_descriptor, 65536)
+        offset = 0
+        while offset < len(data):
+            watch_descriptor, mask, cookie, name_length = EVENT_HEADER.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + name_length].rstrip(b"\0"))
+            offset += EVENT_HEADER.size + name_length
+            if mask & IN_Q_OVERFLOW:
+                is_overflowed = True
+            elif mask & IN_IGNORED:
+                self._watched_dirs.pop(watch_descriptor, None)
+            elif watch_descriptor in self._watched_dirs:
+                path = self._watched_dirs[watch_descriptor] + name
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO) and (is_skipped_dir is None or not is_skipped_dir(path + "/")):
+                        changed_paths.extend(self.add_tree(path + "/", is_skipped_dir))
+                else:
+                    changed_paths.append(path)
+        return changed_paths, is_overflowed
+
+    def close(self):
+        """
+         @brief Stop watching and close the inotify descriptor.
+        """
+        os.close(self._file_descriptor)
+        self._watched_dirs = dict()
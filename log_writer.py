@@ -0,0 +1,45 @@
+import os
+import time
+
+
+class LogWriter:
+    def __init__(self, log_dir, flush_seconds):
+        """
+         @brief Initialize the writer. Log files are opened once in append mode and written through a buffer that is
+                flushed every flush_seconds, instead of being opened and closed for every line
+         @param log_dir Directory of the log files, ending with a "/"
+         @param flush_seconds Seconds between flushes of the buffered lines
+        """
+        self._log_dir = log_dir
+        self._flush_seconds = flush_seconds
+        self._log_files = dict()
+        self._last_flush = time.monotonic()
+
+    def write(self, log_content, log_name):
+        """
+         @brief Append a line to a log file.
+         @param log_content Line to write, without the line break
+         @param log_name Name of the log file, e.g. "removed.txt"
+        """
+        if log_name not in self._log_files:
+            os.makedirs(self._log_dir, exist_ok=True)
+            self._log_files[log_name] = open(f"{self._log_dir}{log_name}", "a", encoding="utf-8", buffering=1048576)
+        self._log_files[log_name].write(log_content + "\n")
+        if time.monotonic() - self._last_flush >= self._flush_seconds:
+            self.flush()
+
+    def flush(self):
+        """
+         @brief Write the buffered lines of every log file to disk.
+        """
+        for log_file in self._log_files.values():
+            log_file.flush()
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        """
+         @brief Flush and close every log file.
+        """
+        for log_file in self._log_files.values():
+            log_file.close()
+        self._log_files = dict()
@@ -0,0 +1,177 @@
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class Metrics:
+    def __init__(self, config):
+        """
+         @brief Initialize the metrics. Counters, stage timings and queue depths are updated by the scan and read back as
+                a throttled progress line, a periodic JSON stats file and, when METRICS_PORT is set, a Prometheus text
+                endpoint on localhost. Updates come from the walk threads and the pool result thread, so they are locked
+         @param config A config object that contains the configuration for the task
+        """
+        self._config = config
+        self._lock = threading.Lock()
+        self._counters = dict()
+        self._stage_seconds = dict()
+        self._gauges = dict()
+        self._start_time = time.monotonic()
+        self._progress_seconds = self._config.get("PROGRESS_SECONDS", 5)
+        self._stats_seconds = self._config.get("STATS_SECONDS", 30)
+        self._stats_path = self._config.get("STATS_PATH", f"{self._config.get_root_dir()}log/stats.json")
+        self._last_progress = self._last_stats = self._start_time
+        self._server = None
+
+    def add(self, name, value=1):
+        """
+         @brief Add to a counter.
+         @param name Name of the counter, e.g. "scanned_files"
+         @param value Amount to add
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def add_stage_time(self, stage, seconds):
+        """
+         @brief Add time spent in a stage, for stages timed elsewhere such as hashing in the workers.
+         @param stage Name of the stage, e.g. "walk"
+         @param seconds Time spent in seconds
+        """
+        with self._lock:
+            self._stage_seconds[stage] = self._stage_seconds.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, stage):
+        """
+         @brief Time the body of a with statement as a stage.
+         @param stage Name of the stage, e.g. "act"
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage_time(stage, time.perf_counter() - start_time)
+
+    def set_gauge(self, name, value):
+        """
+         @brief Set a value that goes up and down, such as a queue depth.
+         @param name Name of the gauge, e.g. "queued_batches"
+         @param value Current value
+        """
+        with self._lock:
+            self._gauges[name] = value
+
+    def get_stats(self):
+        """
+         @brief Get a snapshot of every metric, with the rates derived from the counters.
+         @return Dictionary with "elapsed_seconds", "counters", "stage_seconds", "gauges" and "rates"
+        """
+        with self._lock:
+            counters, stage_seconds, gauges = dict(self._counters), dict(self._stage_seconds), dict(self._gauges)
+        gauges["queued_batches"] = counters.get("dispatched_batches", 0) - counters.get("hashed_batches", 0)
+        elapsed_seconds = max(time.monotonic() - self._start_time, 1e-9)
+        cache_lookups = counters.get("cache_hits", 0) + counters.get("cache_misses", 0)
+        rates = {"files_per_second": counters.get("scanned_files", 0) / elapsed_seconds,
+                 "hashed_bytes_per_second": counters.get("hashed_bytes", 0) / elapsed_seconds,
+                 "cache_hit_ratio": counters.get("cache_hits", 0) / cache_lookups if cache_lookups else 0.0}
+        return {"elapsed_seconds": elapsed_seconds, "counters": counters, "stage_seconds": stage_seconds, "gauges": gauges, "rates": rates}
+
+    def _get_progress_line(self, stats):
+        counters, gauges, rates = stats["counters"], stats["gauges"], stats["rates"]
+        return (f"{stats['elapsed_seconds']:.0f}s: scanned {counters.get('scanned_files', 0)} files ({rates['files_per_second']:.0f}/s), "
+                f"hashed {counters.get('hashed_bytes', 0) / pow(1024, 2):.0f} MB ({rates['hashed_bytes_per_second'] / pow(1024, 2):.1f} MB/s), "
+                f"cache hits {rates['cache_hit_ratio']:.0%}, {gauges.get('pending_dirs', 0)} directories and {gauges.get('queued_batches', 0)} batches queued")
+
+    def report(self, force=False):
+        """
+         @brief Print the progress line every PROGRESS_SECONDS and write the stats file every STATS_SECONDS. Cheap enough to call per file
+         @param force Report now, whatever the time since the last report
+        """
+        now = time.monotonic()
+        is_progress_due = self._progress_seconds and (force or now - self._last_progress >= self._progress_seconds)
+        is_stats_due = self._stats_seconds and (force or now - self._last_stats >= self._stats_seconds)
+        if not is_progress_due and not is_stats_due:
+            return
+        stats = self.get_stats()
+        if is_progress_due:
+            self._last_progress = now
+            print(self._get_progress_line(stats), file=sys.stderr, flush=True)
+        if is_stats_due:
+            self._last_stats = now
+            self._write_stats(stats)
+
+    def _write_stats(self, stats):
+        """
+         @brief Write the stats to STATS_PATH, replacing the previous file only once the new one is complete.
+         @param stats Dictionary returned by get_stats
+        """
+        try:
+            os.makedirs(os.path.dirname(self._stats_path) or ".", exist_ok=True)
+            with open(self._stats_path + ".tmp", "w", encoding="utf-8") as stats_file:
+                json.dump(stats, stats_file, indent=1)
+            os.replace(self._stats_path + ".tmp", self._stats_path)
+        except OSError as e:
+            print(f"Error: stats cannot be written to {self._stats_path}, {e}", file=sys.stderr)
+
+    def get_prometheus_text(self):
+        """
+         @brief Format the metrics in the Prometheus text exposition format.
+         @return Text of the metrics, every name prefixed with "dedup_"
+        """
+        stats = self.get_stats()
+        lines = [f"dedup_elapsed_seconds {stats['elapsed_seconds']}"]
+        for name, value in sorted(stats["counters"].items()):
+            lines.append(f"# TYPE dedup_{name}_total counter")
+            lines.append(f"dedup_{name}_total {value}")
+        lines.append("# TYPE dedup_stage_seconds_total counter")
+        for stage, seconds in sorted(stats["stage_seconds"].items()):
+            lines.append(f'dedup_stage_seconds_total{{stage="{stage}"}} {seconds}')
+        for name, value in sorted(list(stats["gauges"].items()) + list(stats["rates"].items())):
+            lines.append(f"# TYPE dedup_{name} gauge")
+            lines.append(f"dedup_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def start_server(self):
+        """
+         @brief Serve the metrics on http://127.0.0.1:METRICS_PORT/metrics in a background thread, if METRICS_PORT is set.
+        """
+        port = self._config.get("METRICS_PORT")
+        if not port or self._server is not None:
+            return
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.get_prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self._server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+        except OSError as e:
+            print(f"Error: metrics cannot be served on port {port}, {e}", file=sys.stderr)
+            return
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def close(self):
+        """
+         @brief Write the final stats and stop the metrics endpoint.
+        """
+        if self._stats_seconds:
+            self._write_stats(self.get_stats())
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
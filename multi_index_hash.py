@@ -0,0 +1,62 @@
+import itertools
+from array import array
+
+# 64-bit hashes are split into this many 16-bit chunks
+CHUNK_COUNT = 4
+CHUNK_BITS = 16
+
+
+class MultiIndexHash:
+    def __init__(self, max_distance):
+        """
+         @brief Initialize an empty multi-index hash of 64-bit hashes under the Hamming distance. Each hash is indexed by
+                its 16-bit chunks in one table per chunk. Two hashes within max_distance bits have at least one chunk
+                within max_distance // 4 bits of each other, so a search only looks up the few chunk values that close
+                and compares the hashes found there, instead of every hash
+         @param max_distance Largest number of differing bits searched for
+        """
+        self._max_distance = max_distance
+        self._chunk_distance = max_distance // CHUNK_COUNT
+        self._hashes = array("Q")
+        self._items = list()
+        self._tables = [dict() for chunk in range(CHUNK_COUNT)]
+        # XOR masks of every chunk value within the chunk distance of a chunk
+        self._chunk_masks = [0]
+        for bit_count in range(1, self._chunk_distance + 1):
+            self._chunk_masks.extend(sum(1 << bit for bit in bits) for bits in itertools.combinations(range(CHUNK_BITS), bit_count))
+
+    def __len__(self):
+        return len(self._items)
+
+    def _get_chunks(self, hash_value):
+        return [(hash_value >> (chunk * CHUNK_BITS)) & ((1 << CHUNK_BITS) - 1) for chunk in range(CHUNK_COUNT)]
+
+    def add(self, hash_value, item):
+        """
+         @brief Add an item under a hash.
+         @param hash_value 64-bit integer hash
+         @param item Value returned by search
+        """
+        row = len(self._items)
+        self._hashes.append(hash_value)
+        self._items.append(item)
+        for table, chunk_value in zip(self._tables, self._get_chunks(hash_value)):
+            table.setdefault(chunk_value, []).append(row)
+
+    def search(self, hash_value):
+        """
+         @brief Find the items whose hash is within max_distance bits of a hash.
+         @param hash_value 64-bit integer hash
+         @return List of (distance, item) tuples, closest first
+        """
+        rows = set()
+        for table, chunk_value in zip(self._tables, self._get_chunks(hash_value)):
+            for chunk_mask in self._chunk_masks:
+                rows.update(table.get(chunk_value ^ chunk_mask, ()))
+        matches = list()
+        for row in rows:
+            distance = (self._hashes[row] ^ hash_value).bit_count()
+            if distance <= self._max_distance:
+                matches.append((distance, row))
+        matches.sort()
+        return [(distance, self._items[row]) for distance, row in matches]
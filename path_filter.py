@@ -0,0 +1,90 @@
+import re
+import fnmatch
+
+# FILE_EXTENSIONS entries that select every file, "*.*" is what the extension window of config_interface saves
+ALL_EXTENSIONS = {"*.*", "*", ".*"}
+
+
+def _compile_patterns(patterns, flags):
+    """
+     @brief Compile glob patterns into a single regular expression, so a name is matched against all of them at once.
+     @param patterns List of glob patterns
+     @param flags Regular expression flags
+     @return Compiled regular expression, or None if there are no patterns
+    """
+    if not patterns:
+        return None
+    return re.compile("|".join(f"(?:{fnmatch.translate(pattern)})" for pattern in patterns), flags)
+
+
+class PathFilter:
+    def __init__(self, config):
+        """
+         @brief Initialize the filter. FILE_EXTENSIONS, INCLUDE_PATTERNS, EXCLUDE_PATTERNS, MIN_FILE_SIZE and MAX_FILE_SIZE
+                are compiled once here and then applied to the raw names of the directory listing, so files and
+                directories that are filtered out are never stat'ed. Patterns without a "/" match the name of a file or
+                directory, patterns with one match its whole path, directory paths ending with a "/"
+         @param config A config object that contains the configuration for the task
+        """
+        self._config = config
+        extensions = set(extension.lower().lstrip("*").lstrip(".") if extension not in ALL_EXTENSIONS else extension
+                         for extension in self._config.get("FILE_EXTENSIONS", []))
+        # None selects every extension
+        self._extensions = None if extensions & ALL_EXTENSIONS else frozenset(extensions)
+        # Windows paths are case insensitive, the extensions are compared in lower case everywhere
+        flags = re.IGNORECASE if self._config.get_os_name() == "win32" else 0
+        include_patterns, exclude_patterns = self._config.get("INCLUDE_PATTERNS", []), self._config.get("EXCLUDE_PATTERNS", [])
+        self._include_name = _compile_patterns([pattern for pattern in include_patterns if "/" not in pattern], flags)
+        self._include_path = _compile_patterns([pattern for pattern in include_patterns if "/" in pattern], flags)
+        self._exclude_name = _compile_patterns([pattern for pattern in exclude_patterns if "/" not in pattern], flags)
+        self._exclude_path = _compile_patterns([pattern for pattern in exclude_patterns if "/" in pattern], flags)
+        self._min_size = self._config.get("MIN_FILE_SIZE", 0)
+        self._max_size = self._config.get("MAX_FILE_SIZE")
+        self._dest_path = self._config.get("DEST_PATH")
+
+    def get_extension(self, name):
+        """
+         @brief Get the extension of a file name the way pathlib does, without building a Path.
+         @param name Name of the file
+         @return Extension in lower case without the dot, empty for names like ".bashrc"
+        """
+        dot_index = name.rfind(".")
+        return name[dot_index + 1:].lower() if dot_index > 0 else ""
+
+    def is_target_file(self, name, path):
+        """
+         @brief Check whether a file is scanned, from its name and path alone.
+         @param name Name of the file
+         @param path Path of the file
+         @return True if the file has one of the FILE_EXTENSIONS, matches INCLUDE_PATTERNS when set and matches none of
+                 the EXCLUDE_PATTERNS
+        """
+        if self._extensions is not None and self.get_extension(name) not in self._extensions:
+            return False
+        if self._include_name is not None or self._include_path is not None:
+            if not ((self._include_name is not None and self._include_name.match(name))
+                    or (self._include_path is not None and self._include_path.match(path))):
+                return False
+        if self._exclude_name is not None and self._exclude_name.match(name):
+            return False
+        return self._exclude_path is None or self._exclude_path.match(path) is None
+
+    def is_target_size(self, size):
+        """
+         @brief Check whether a file size is between MIN_FILE_SIZE and MAX_FILE_SIZE.
+         @param size Size of the file in bytes
+         @return True if the file is scanned
+        """
+        return size >= self._min_size and (self._max_size is None or size <= self._max_size)
+
+    def is_excluded_dir(self, dir_path):
+        """
+         @brief Check whether a directory is skipped with everything below it, so it is never listed.
+         @param dir_path Path of the directory, ending with a "/"
+         @return True for DEST_PATH and for directories matching one of the EXCLUDE_PATTERNS
+        """
+        if dir_path == self._dest_path:
+            return True
+        if self._exclude_name is not None and self._exclude_name.match(dir_path.rstrip("/").rsplit("/", 1)[-1]):
+            return True
+        return self._exclude_path is not None and self._exclude_path.match(dir_path) is not None
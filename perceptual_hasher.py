@@ -0,0 +1,113 @@
+import math
+import logging
+
+# NumPy and Pillow are only needed for near-duplicate detection, which is off when they are not installed
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = logging.getLogger("file_manager")
+
+# Extensions Pillow decodes out of the box, HEIC and AVIF need plugins such as pillow-heif
+IMAGE_EXTENSIONS = {"jpg", "jpeg", "png", "gif", "bmp", "tif", "tiff", "webp"}
+# Images are shrunk to this size for the pHash DCT, only its top left 8x8 frequencies are kept
+PHASH_IMAGE_SIZE = 32
+HASH_SIZE = 8
+
+
+def _get_dct_matrix(size):
+    """
+     @brief Build the orthonormal DCT-II matrix, so a batch of images is transformed with two matrix products.
+     @param size Width and height of the images
+     @return size x size float32 array
+    """
+    dct_matrix = numpy.empty((size, size), dtype=numpy.float32)
+    for frequency in range(size):
+        scale = math.sqrt((1 if frequency == 0 else 2) / size)
+        for position in range(size):
+            dct_matrix[frequency, position] = scale * math.cos(math.pi * (2 * position + 1) * frequency / (2 * size))
+    return dct_matrix
+
+
+class PerceptualHasher:
+    def __init__(self):
+        """
+         @brief Initialize the hasher. It computes 64-bit dHash and pHash fingerprints of images, which stay within a few
+                bits of each other when an image is re-encoded, resized or slightly edited
+        """
+        self._dct_matrix = _get_dct_matrix(PHASH_IMAGE_SIZE) if numpy is not None else None
+
+    @staticmethod
+    def is_available():
+        """
+         @brief Check whether NumPy and Pillow are installed.
+         @return True if fingerprints can be computed
+        """
+        return numpy is not None and Image is not None
+
+    def _load_image(self, file_path):
+        """
+         @brief Load an image as the small grayscale arrays the hashes are computed from. JPEG files are decoded at a
+                reduced scale, which is much faster than decoding them at full size
+         @param file_path Path of the image
+         @return Tuple of (HASH_SIZE x HASH_SIZE + 1 array for the dHash, PHASH_IMAGE_SIZE x PHASH_IMAGE_SIZE array for the pHash,
+                 number of pixels of the full image)
+        """
+        with Image.open(file_path) as image:
+            pixel_count = image.width * image.height
+            image.draft("L", (PHASH_IMAGE_SIZE * 2, PHASH_IMAGE_SIZE * 2))
+            gray_image = image.convert("L")
+        dhash_pixels = numpy.asarray(gray_image.resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR), dtype=numpy.float32)
+        phash_pixels = numpy.asarray(gray_image.resize((PHASH_IMAGE_SIZE, PHASH_IMAGE_SIZE), Image.BILINEAR), dtype=numpy.float32)
+        return dhash_pixels, phash_pixels, pixel_count
+
+    def _pack_bits(self, bits):
+        """
+         @brief Pack a batch of 64 booleans per image into integers.
+         @param bits N x 64 boolean array
+         @return List of N integers
+        """
+        return [int.from_bytes(row.tobytes(), "big") for row in numpy.packbits(bits, axis=1)]
+
+    def get_fingerprints(self, file_paths):
+        """
+         @brief Compute the fingerprints of a batch of images. The images are decoded one by one, then both hashes of the
+                whole batch are computed with vectorized NumPy operations
+         @param file_paths List of image paths
+         @return Dictionary mapping the path of each readable image to a fingerprint string of its dHash and pHash as 16 hex
+                 digits each, followed by ":" and its number of pixels
+        """
+        loaded_paths, pixel_counts, dhash_batch, phash_batch = list(), list(), list(), list()
+        for file_path in file_paths:
+            try:
+                dhash_pixels, phash_pixels, pixel_count = self._load_image(file_path)
+            except Exception as e:
+                logger.warning(f"{file_path} is not a readable image, {e}")
+                continue
+            loaded_paths.append(file_path)
+            pixel_counts.append(pixel_count)
+            dhash_batch.append(dhash_pixels)
+            phash_batch.append(phash_pixels)
+        if not loaded_paths:
+            return dict()
+        dhash_pixels, phash_pixels = numpy.stack(dhash_batch), numpy.stack(phash_batch)
+        # dHash: is each pixel brighter than its right neighbour
+        dhashes = self._pack_bits((dhash_pixels[:, :, 1:] > dhash_pixels[:, :, :-1]).reshape(len(loaded_paths), -1))
+        # pHash: is each low frequency of the DCT above the median of the low frequencies
+        frequencies = (self._dct_matrix @ phash_pixels @ self._dct_matrix.T)[:, :HASH_SIZE, :HASH_SIZE].reshape(len(loaded_paths), -1)
+        phashes = self._pack_bits(frequencies > numpy.median(frequencies, axis=1, keepdims=True))
+        return {file_path: f"{dhash:016x}{phash:016x}:{pixel_count}" for file_path, dhash, phash, pixel_count in zip(loaded_paths, dhashes, phashes, pixel_counts)}
+
+
+def split_fingerprint(fingerprint):
+    """
+     @brief Split a fingerprint string into its hashes.
+     @param fingerprint Fingerprint string returned by PerceptualHasher.get_fingerprints
+     @return Tuple of (dHash, pHash, number of pixels) integers
+    """
+    return int(fingerprint[:16], 16), int(fingerprint[16:32], 16), int(fingerprint[33:])
@@ -0,0 +1,30 @@
+import os
+import sys
+import json
+import shutil
+
+
+def run_action(action):
+    """
+     @brief Run a file action read from the parent process.
+     @param action Dictionary with "action" ("remove" or "move"), "file_path" and for moves "dest_path"
+     @return Dictionary with "ok" and, when the action failed, "error"
+    """
+    try:
+        if action["action"] == "remove":
+            os.remove(action["file_path"])
+        elif action["action"] == "move":
+            shutil.move(action["file_path"], action["dest_path"])
+        else:
+            return {"ok": False, "error": f"Unknown action {action['action']}"}
+        return {"ok": True}
+    except OSError as e:
+        return {"ok": False, "error": str(e)}
+
+
+# The ActionExecutor starts this script once with sudo and sends it the actions it has no permission for,
+# one JSON line per action, instead of forking a sudo shell per file.
+if __name__ == "__main__":
+    for line in sys.stdin:
+        sys.stdout.write(json.dumps(run_action(json.loads(line))) + "\n")
+        sys.stdout.flush()
@@ -0,0 +1,103 @@
+import os, sys
+import json
+import heapq
+import itertools
+from config import Config
+from dedup_planner import DedupPlanner
+from index_shard import read_shard, read_shard_header
+
+
+class ShardMerger:
+    def __init__(self, config):
+        """
+         @brief Initialize the merger. It merges the index shards written by the nodes with RUN_MODE "shard" into one plan
+                per node. The shards are sorted the same way, so they are merged as streams and only one duplicate group
+                is held in memory at a time, whatever the number of files
+         @param config A config object that contains the configuration for the task
+        """
+        self._config = config
+        self._planner = DedupPlanner(self._config)
+
+    def get_plan_dir(self):
+        """
+         @brief Get the directory the node plans are written to.
+         @return SHARD_PLAN_DIR, or plan/nodes/ in the root directory by default
+        """
+        return self._config.get("SHARD_PLAN_DIR", f"{self._config.get_root_dir()}plan/nodes/")
+
+    def _iter_shard(self, shard_path, node_name):
+        """
+         @brief Read the rows of a shard tagged with the node they come from.
+         @param shard_path Path of the shard file
+         @param node_name Name of the node that wrote it
+         @return Iterator over (size, hash, path, file key, node name) tuples
+        """
+        for size, file_hash, path, file_key in read_shard(shard_path):
+            yield size, file_hash, path, file_key, node_name
+
+    def _get_keeper_key(self, row):
+        """
+         @brief Get the sort key of a merged row for the KEEPER_POLICY, ties between equal paths on several nodes are broken by node.
+         @param row Tuple of (size, hash, path, file key, node name)
+         @return Tuple to sort the files of a group by
+        """
+        size, file_hash, path, file_key, node_name = row
+        return self._planner.get_keeper_key((path, size, file_key)) + (node_name,)
+
+    def merge(self, shard_paths):
+        """
+         @brief Merge shards and write the plan of each node. A node plan lists the groups the node has duplicates in, in
+                the plan format of DedupPlanner plus "keeper_node", the node holding the keeper. Each node then runs
+                RUN_MODE "apply" with PLAN_PATH set to its plan, duplicates kept on another node are only removed there
+                with TRUST_REMOTE_KEEPERS set
+         @param shard_paths Paths of the shard files, one per node
+         @return Dictionary mapping a node name to a tuple of (plan path, number of duplicates, reclaimable bytes)
+        """
+        node_names = list()
+        for shard_path in shard_paths:
+            node_name = read_shard_header(shard_path)["node"]
+            if node_name in node_names:
+                raise ValueError(f"{shard_path} comes from node {node_name}, which has another shard already")
+            node_names.append(node_name)
+        plan_dir = self.get_plan_dir()
+        os.makedirs(plan_dir, exist_ok=True)
+        plan_paths = {node_name: f"{plan_dir}{node_name}.jsonl" for node_name in node_names}
+        plan_files = {node_name: open(plan_path + ".tmp", "w", encoding="utf-8") for node_name, plan_path in plan_paths.items()}
+        totals = {node_name: [0, 0] for node_name in node_names}
+        try:
+            rows = heapq.merge(*[self._iter_shard(shard_path, node_name) for shard_path, node_name in zip(shard_paths, node_names)],
+                               key=lambda row: (row[0], row[1]))
+            for (size, file_hash), group_rows in itertools.groupby(rows, key=lambda row: (row[0], row[1])):
+                group_rows = sorted(group_rows, key=self._get_keeper_key)
+                if len(group_rows) == 1:
+                    continue
+                keeper = group_rows[0]
+                keeper_inode = self._planner.get_inode(keeper[3])
+                node_duplicates = dict()
+                for row in group_rows[1:]:
+                    # Inodes are only comparable on the same node, paths hardlinked to the keeper free nothing
+                    if row[4] == keeper[4] and self._planner.get_inode(row[3]) == keeper_inode:
+                        continue
+                    node_duplicates.setdefault(row[4], []).append([row[2], row[3]])
+                for node_name, duplicates in node_duplicates.items():
+                    group = {"size": size, "hash": file_hash, "keeper": [keeper[2], keeper[3]], "keeper_node": keeper[4], "duplicates": duplicates}
+                    plan_files[node_name].write(json.dumps(group, ensure_ascii=False, separators=(",", ":")) + "\n")
+                    totals[node_name][0] += len(duplicates)
+                    totals[node_name][1] += size * len(set(self._planner.get_inode(file_key) for path, file_key in duplicates))
+        finally:
+            for plan_file in plan_files.values():
+                plan_file.close()
+        for plan_path in plan_paths.values():
+            os.replace(plan_path + ".tmp", plan_path)
+        return {node_name: (plan_paths[node_name], duplicate_count, reclaimable_size) for node_name, (duplicate_count, reclaimable_size) in totals.items()}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} SHARD_PATH...")
+        sys.exit(2)
+    config = Config()
+    config.set_root_dir(config.get("ROOT_DIR", os.path.dirname(os.path.abspath(__file__))).replace("\\", "/").rstrip("/") + "/")
+    config.set_os_name(sys.platform)
+    for node_name, (plan_path, duplicate_count, reclaimable_size) in ShardMerger(config).merge(sys.argv[1:]).items():
+        print(f"Planned {duplicate_count} duplicates on {node_name} in {plan_path}, {reclaimable_size / pow(1024, 3)} GB reclaimable")
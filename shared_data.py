@@ -1,6 +1,7 @@
-import json
+import os
 from config import Config
-from multiprocessing import Manager
+from compact_index import CompactIndex, RecordStore
+from cache_store import CacheStore
 
 class SharedData:
     def __init__(self, config):
@@ -9,121 +10,213 @@ class SharedData:
          @param config The configuration dictionary to use for this cache instance
         """
         self._config = config
-        self._hash_dict = Manager().dict()
-        self._size_dict = Manager().dict()
-        self._total_removal_size = Manager().Value(float, 0.0)
-        self._total_removal_count = Manager().Value("i", 0)
-        self._total_moved_size = Manager().Value(float, 0.0)
-        self._total_moved_count = Manager().Value("i", 0)
-        # If the cache is readable, this method will construct the dictionaries
-        if self._config.get("IS_CACHE_READABLE"):
-            self._construct_dicts()
-
-    def _construct_dicts(self):
-        """
-         @brief Construct hash and size dictionaries from cache. This is called from __init__ and should not be called
-        """
-        try:
-            hash_cache = json.load(open(f"{self._config.get_root_dir()}cache/hash-dict.json", "r"))
-            size_cache = json.load(open(f"{self._config.get_root_dir()}cache/size-dict.json", "r"))
-            self._hash_dict = Manager().dict(hash_cache)
-            self._size_dict = Manager().dict(size_cache)
-        except:
-            print("Caches not found")
+        # Only the parent process makes dedup decisions, workers send their results back to it,
+        # so the indexes and totals are process-local and need no locking
+        self._total_removal_size = 0.0
+        self._total_removal_count = 0
+        self._total_moved_size = 0.0
+        self._total_moved_count = 0
+        self._total_linked_size = 0.0
+        self._total_linked_count = 0
+        # Sizes and raw digests of kept files, created with the digest length of the first hash added
+        self._digest_index = None
+        self._keeper_paths = self._open_keeper_paths()
+        self._cache_store = self._open_cache_store()
+
+    def _open_keeper_paths(self):
+        """
+         @brief Open the store of the keeper paths. They are only needed when duplicates are replaced by links, so they are
+                not kept in remove mode. Paths are written to disk and the digest index keeps their offset
+         @return RecordStore of the keeper paths, or None in remove mode
+        """
+        if self._config.get("DEDUP_MODE", "remove") == "remove":
+            return None
+        return RecordStore(self._config.get("INDEX_SPILL_DIR"))
+
+    def _open_cache_store(self):
+        """
+         @brief Open the file index. It lives in cache/file-index.sqlite3 when the cache is readable or writable, and only in
+                memory for this run otherwise. This is called from __init__ and should not be called
+         @return CacheStore of the file index
+        """
+        is_readable, is_writable = self._config.get("IS_CACHE_READABLE"), self._config.get("IS_CACHE_WRITABLE")
+        if not is_readable and not is_writable:
+            return CacheStore(":memory:", True, 10000, 30)
+        cache_dir = f"{self._config.get_root_dir()}cache/"
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_store = CacheStore(f"{cache_dir}file-index.sqlite3", bool(is_writable),
+                                 self._config.get("CACHE_COMMIT_ROWS", 10000), self._config.get("CACHE_COMMIT_SECONDS", 30))
+        if not is_readable:
+            cache_store.clear()
+        return cache_store
 
     def get_total_removal_size(self):
         """
          @brief Gets the total removal size of the file. This is the size of the file that will be removed from the storage when the file is deleted.
          @return The total removable size of the file or 0 if the file does not exist or is not removable
         """
-        return self._total_removal_size.value
+        return self._total_removal_size
 
     def get_total_removal_count(self):
         """
          @brief Gets the total removal count. This is used to determine how many items in the item list are removed from the item's list of items.
          @return The total removals count in the item list or 0 if there are no removals in the item
         """
-        return self._total_removal_count.value
+        return self._total_removal_count
 
     def add_total_removal_size(self, addition):
         """
          @brief Add a number of bytes to the total removal size. This is used to prevent memory leaks and for debugging
          @param addition The number of bytes to
         """
-        self._total_removal_size.value += addition
+        self._total_removal_size += addition
 
     def add_total_removal_count(self, addition):
         """
          @brief Add a number to the total removal count. This is used to prevent accidental garbage collection of a job that is about to be deleted
          @param addition The number to add
         """
-        self._total_removal_count.value += addition
+        self._total_removal_count += addition
 
     def get_total_moved_count(self):
-        return self._total_moved_count.value
+        return self._total_moved_count
 
     def get_total_moved_size(self):
-        return self._total_moved_size.value
+        return self._total_moved_size
 
-    def _add_total_moved_count(self, addition):
-        self._total_moved_count.value += addition
+    def add_total_moved_count(self, addition):
+        self._total_moved_count += addition
 
-    def _add_total_moved_size(self, addition):
-        self._total_moved_size.value += addition
+    def add_total_moved_size(self, addition):
+        self._total_moved_size += addition
 
-    def get_hash_dict(self):
+    def get_total_linked_count(self):
+        return self._total_linked_count
+
+    def get_total_linked_size(self):
+        return self._total_linked_size
+
+    def add_total_linked_count(self, addition):
+        self._total_linked_count += addition
+
+    def add_total_linked_size(self, addition):
+        self._total_linked_size += addition
+
+    def _get_digest_bytes(self, file_hash):
+        """
+         @brief Get the raw bytes of a algorithm:hexdigest hash, half the size of the hex string.
+         @param file_hash Hash as returned by Hasher.get_digest
+         @return Raw digest bytes
+        """
+        return bytes.fromhex(file_hash.rsplit(":", 1)[-1])
+
+    def add_file_digest(self, file_size, file_hash, file_path=None):
+        """
+         @brief Register the size and hash of a kept file, so later files with the same size and hash are duplicates.
+         @param file_size Size of the file in bytes
+         @param file_hash Hash of the file as returned by Hasher.get_digest
+         @param file_path Path of the kept file, remembered when duplicates are linked to their keeper
+        """
+        digest = self._get_digest_bytes(file_hash)
+        if self._digest_index is None:
+            self._digest_index = CompactIndex(len(digest), self._config.get("INDEX_MEMORY_LIMIT", 1073741824), self._config.get("INDEX_SPILL_DIR"))
+        elif self._digest_index.contains(file_size, digest):
+            return
+        # 0 stands for no keeper path, the offsets are shifted by one
+        keeper_offset = 0
+        if self._keeper_paths is not None and file_path is not None:
+            keeper_offset = self._keeper_paths.add([file_path]) + 1
+        self._digest_index.add(file_size, digest, keeper_offset)
+
+    def get_keeper_path(self, file_size, file_hash):
+        """
+         @brief Get the path of the kept file with a given size and hash, when duplicates are linked to their keeper.
+         @param file_size Size of the file in bytes
+         @param file_hash Hash of the file as returned by Hasher.get_digest
+         @return Path of the kept file, or None if unknown
+        """
+        if self._keeper_paths is None or self._digest_index is None:
+            return None
+        keeper_offset = self._digest_index.get(file_size, self._get_digest_bytes(file_hash))
+        if not keeper_offset:
+            return None
+        return self._keeper_paths.get(keeper_offset - 1)[0]
+
+    def has_file_digest(self, file_size, file_hash):
+        """
+         @brief Check whether a file with the same size and hash was kept before.
+         @param file_size Size of the file in bytes
+         @param file_hash Hash of the file as returned by Hasher.get_digest
+         @return True if the file is a duplicate of a kept file
+        """
+        if self._digest_index is None:
+            return False
+        return self._digest_index.contains(file_size, self._get_digest_bytes(file_hash))
+
+    def get_indexed_file(self, file_key):
+        """
+         @brief Get the file index entry of a file. A file whose inode, size or mtime changed has a different key and is not found
+         @param file_key Key of the file as built by FileManager._get_file_key
+         @return Dictionary with the path, partial hash, hash and fingerprint of the file, or None if not indexed
+        """
+        return self._cache_store.get_by_key(file_key)
+
+    def get_indexed_path(self, path):
         """
-         @brief Gets the hash_dict of this V1alpha1VirtualMachineSnapshotSpec. # noqa : E501 A dictionary of hash values keyed by UUID
-         @return The hash_dict of this V1alpha1VirtualMachineSnapshotSpec
+         @brief Get the file index entry of a path, whether or not the file changed since it was indexed.
+         @param path Path of the file
+         @return Dictionary with the file key, partial hash and hash of the file, or None if not indexed
         """
-        return self._hash_dict
+        return self._cache_store.get_by_path(path)
 
-    def get_size_dict(self):
+    def get_indexed_files_by_size(self, size):
         """
-         @brief Gets the size_dict of this V1alpha1MetricStatus. # noqa : E501 Specifies the size of the metric in MiB.
-         @return The size_dict of this V1alpha1MetricStatus or None if not set or unknown ( default : None
+         @brief Get the indexed files of a given size.
+         @param size Size of the files in bytes
+         @return List of (path, file key) tuples
         """
-        return self._size_dict
+        return self._cache_store.get_by_size(size)
 
-    def set_hash(self, hash_key, value):
+    def iter_indexed_files(self):
         """
-         @brief Set a hash value. This is used to save the state of the file when it is loaded.
-         @param hash_key The key to store the hash value under.
-         @param value The value to store under the key ( must be a string
+         @brief Iterate over every indexed file. Entries may be removed while iterating
+         @return Iterator over (path, file key) tuples
         """
-        self._hash_dict[hash_key] = value
+        return self._cache_store.iter_rows()
 
-    def get_hash(self, hash):
+    def set_indexed_file(self, file_key, path, size, partial=None, hash=None, fingerprint=None):
         """
-         @brief Get the value associated with the hash. This is used to determine if there is a cache entry that has the same hash or not
-         @param hash The hash to look up
-         @return The value associated with the hash or None if not found ( no cache entry is found for the hash
+         @brief Add or update the file index entry of a path. Hashes that are not given keep their indexed value
+         @param file_key Key of the file as built by FileManager._get_file_key
+         @param path Path of the file
+         @param size Size of the file in bytes
+         @param partial Partial hash of the file
+         @param hash Full hash of the file
+         @param fingerprint Perceptual fingerprint of the image
         """
-        return self._hash_dict.get(hash)
+        self._cache_store.set(file_key, path, size, partial, hash, fingerprint)
 
-    def set_size(self, size_key, value):
+    def remove_indexed_path(self, path):
         """
-         @brief Set the size of the file. This is a helper for : meth : ` set_file ` to be used in order to set the size of the file in bytes.
-         @param size_key The key for the size. It must be a string of the form ` ` file_name. size ` ` e. g.
-         @param value The size of the file in bytes. It must be a string of the form ` ` file_name. size
+         @brief Remove the file index entry of a path, if present.
+         @param path Path of the file
         """
-        self._size_dict[size_key] = value
+        self._cache_store.remove_by_path(path)
 
-    def get_size(self, size):
+    def commit_file_index(self):
         """
-         @brief Get size of file. This is used to determine the size of a file based on its size in bytes.
-         @param size Size of file in bytes. Can be any of the following : 1.
-         @return Size of file in bytes
+         @brief Commit the pending file index changes now, for long running processes that may stay idle for a while.
         """
-        return self._size_dict.get(size)
+        self._cache_store.commit()
 
-    def write_cache(self, cache_file, value):
+    def close(self):
         """
-         @brief Write a value to the cache. This is used to cache values that need to be recomputed in the next run
-         @param cache_file Name of the cache file
-         @param value Value to write to the cache ( dict or list
+         @brief Release the digest index and its spilled runs on disk, and commit and close the file index.
         """
-        # Save the value to cache file if the cache file is writable
-        if self._config.get("IS_CACHE_WRITABLE"):
-            with open(f"{self._config.get_root_dir()}cache/{cache_file}", "w") as outfile:
-                json.dump(value.copy(), outfile)
\ No newline at end of file
+        if self._digest_index is not None:
+            self._digest_index.close()
+            self._digest_index = None
+        if self._keeper_paths is not None:
+            self._keeper_paths.close()
+            self._keeper_paths = None
+        self._cache_store.close()
\ No newline at end of file
@@ -0,0 +1,168 @@
+import heapq
+from array import array
+from compact_index import RecordStore
+
+# Offset of the sizes shared by several files in the lookup table, their files are in the buckets instead of the store
+SHARED_OFFSET = -2
+
+
+def _read_run(run_store):
+    """
+     @brief Read back a sorted run of file records.
+     @param run_store RecordStore of the run
+     @return Iterator over the (path, size, file key) tuples of the run
+    """
+    for row in run_store.iter_rows():
+        yield tuple(row)
+
+
+class SizeBuckets:
+    def __init__(self, spill_dir=None):
+        """
+         @brief Initialize the buckets of the scanned files by size. Most sizes are only seen once and their file is never
+                hashed, so it is written to a RecordStore and only its size and offset are kept, in an open addressing
+                table of arrays, 32 to 64 bytes per file instead of several hundred for a tuple in a dict. Sizes shared by
+                several files get a bucket of their records in memory, as their files are hashed and compared
+         @param spill_dir Directory of the temporary files, the system temporary directory by default
+        """
+        self._spill_dir = spill_dir
+        self._store = RecordStore(spill_dir)
+        self._slot_sizes = array("Q", [0]) * 1024
+        # Offset of the record of the only file of a size in the store, SHARED_OFFSET for shared sizes and -1 for empty slots
+        self._slot_offsets = array("q", [-1]) * 1024
+        self._size_count = 0
+        self._buckets = dict()
+
+    def _find_slot(self, slot_sizes, slot_offsets, size):
+        """
+         @brief Find the slot of a size in a lookup table with linear probing. Sizes are spread over the table by Fibonacci hashing
+         @param slot_sizes Sizes of the slots
+         @param slot_offsets Offsets of the slots, -1 for empty slots. The table length is a power of two
+         @param size Size of the files in bytes
+         @return Tuple of (slot, True if the size is in the slot or False if the slot is empty)
+        """
+        mask = len(slot_offsets) - 1
+        slot = ((size * 11400714819323198485) >> 20) & mask
+        while True:
+            if slot_offsets[slot] == -1:
+                return slot, False
+            if slot_sizes[slot] == size:
+                return slot, True
+            slot = (slot + 1) & mask
+
+    def _grow_slots(self):
+        """
+         @brief Double the lookup table and re-insert every size, keeping the table at most half full.
+        """
+        slot_sizes, slot_offsets = array("Q", [0]) * (len(self._slot_sizes) * 2), array("q", [-1]) * (len(self._slot_offsets) * 2)
+        for size, offset in zip(self._slot_sizes, self._slot_offsets):
+            if offset != -1:
+                slot, found = self._find_slot(slot_sizes, slot_offsets, size)
+                slot_sizes[slot], slot_offsets[slot] = size, offset
+        self._slot_sizes, self._slot_offsets = slot_sizes, slot_offsets
+
+    def is_seen(self, size):
+        """
+         @brief Check whether a file of a size was added before.
+         @param size Size of the files in bytes
+         @return True if the size has a single file or a bucket
+        """
+        return self._find_slot(self._slot_sizes, self._slot_offsets, size)[1]
+
+    def add_single(self, file_record):
+        """
+         @brief Add the first file of a size, which has no bucket yet.
+         @param file_record Tuple of (path, size, file key)
+        """
+        slot, found = self._find_slot(self._slot_sizes, self._slot_offsets, file_record[1])
+        self._slot_sizes[slot], self._slot_offsets[slot] = file_record[1], self._store.add(list(file_record))
+        self._size_count += 1
+        if self._size_count * 2 > len(self._slot_offsets):
+            self._grow_slots()
+
+    def pop_single(self, size):
+        """
+         @brief Take the only file of a size back from the store, when a second file of the size is found.
+         @param size Size of the files in bytes
+         @return Tuple of (path, size, file key), or None if the size has no single file
+        """
+        slot, found = self._find_slot(self._slot_sizes, self._slot_offsets, size)
+        if not found or self._slot_offsets[slot] == SHARED_OFFSET:
+            return None
+        file_record = tuple(self._store.get(self._slot_offsets[slot]))
+        self._slot_offsets[slot] = SHARED_OFFSET
+        return file_record
+
+    def get_bucket(self, size):
+        """
+         @brief Get the bucket of a size shared by several files.
+         @param size Size of the files in bytes
+         @return Dictionary mapping a path to its (path, size, file key) tuple, or None if the size has no bucket
+        """
+        return self._buckets.get(size)
+
+    def set_bucket(self, size, size_bucket):
+        """
+         @brief Give a size a bucket, the first time several files have it.
+         @param size Size of the files in bytes
+         @param size_bucket Dictionary mapping a path to its (path, size, file key) tuple
+        """
+        slot, found = self._find_slot(self._slot_sizes, self._slot_offsets, size)
+        if not found:
+            self._size_count += 1
+        self._slot_sizes[slot], self._slot_offsets[slot] = size, SHARED_OFFSET
+        self._buckets[size] = size_bucket
+        if self._size_count * 2 > len(self._slot_offsets):
+            self._grow_slots()
+
+    def get_buckets(self):
+        """
+         @brief Get the buckets of the sizes shared by several files.
+         @return Dictionary mapping a size to its bucket
+        """
+        return self._buckets
+
+    def iter_single_records(self, run_rows):
+        """
+         @brief Read back the files whose size no other file has, sorted by path. The store is sorted in runs of run_rows
+                files that are merged, so they are never all in memory. The store is closed once they are read
+         @param run_rows Maximum number of files sorted in memory at once
+         @return Iterator over (path, size, file key) tuples
+        """
+        run_stores, file_records = list(), list()
+        try:
+            for row in self._store.iter_rows():
+                if row[1] not in self._buckets:
+                    file_records.append(tuple(row))
+                if len(file_records) >= run_rows:
+                    run_stores.append(self._write_run(file_records))
+                    file_records = list()
+            file_records.sort()
+            if not run_stores:
+                yield from file_records
+                return
+            run_stores.append(self._write_run(file_records))
+            file_records = list()
+            yield from heapq.merge(*[_read_run(run_store) for run_store in run_stores])
+        finally:
+            for run_store in run_stores:
+                run_store.close()
+            self.close()
+
+    def _write_run(self, file_records):
+        """
+         @brief Sort file records and write them to a temporary run.
+         @param file_records List of (path, size, file key) tuples
+         @return RecordStore of the run, its rows in path order
+        """
+        file_records.sort()
+        run_store = RecordStore(self._spill_dir)
+        for file_record in file_records:
+            run_store.add(list(file_record))
+        return run_store
+
+    def close(self):
+        """
+         @brief Delete the store of the single files.
+        """
+        self._store.close()
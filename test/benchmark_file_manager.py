@@ -0,0 +1,256 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import itertools
+import subprocess
+
+# Benchmark of the FileManager pipeline on synthetic trees. It is a script and not a pytest module:
+#
+#   python test/benchmark_file_manager.py --files 20000 --duplicate-ratio 0.3 --workers 1,4 --hash-algorithms blake2b,xxh3_128 --output results.jsonl
+#
+# Every combination of the swept settings runs in a fresh process, so peak RSS and syscall counts are its own, and
+# prints one JSON line with the settings, the timings and the counters. Lines of different commits can be diffed or
+# loaded into a dataframe to track regressions.
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FILE_EXTENSION = "jpg"
+# Random files of a few bytes would often be equal by chance and count as unplanned duplicates
+MIN_FILE_SIZE = 16
+
+
+def get_file_size(rng, size_distribution, max_size):
+    """
+     @brief Draw a file size from a size distribution.
+     @param rng random.Random of the tree
+     @param size_distribution "lognormal:MEDIAN:SIGMA" or "uniform:MIN:MAX", sizes in bytes
+     @param max_size Largest size drawn
+     @return Size in bytes, at least MIN_FILE_SIZE
+    """
+    kind, first, second = size_distribution.split(":")
+    if kind == "uniform":
+        size = rng.randint(int(first), int(second))
+    elif kind == "lognormal":
+        size = int(rng.lognormvariate(0, float(second)) * int(first))
+    else:
+        raise ValueError(f"Unknown size distribution {size_distribution}")
+    return max(MIN_FILE_SIZE, min(size, max_size))
+
+
+def get_content(content_seed, size, trap_mask=0):
+    """
+     @brief Generate the content of a file from its seed, so duplicates are written without keeping every file in memory.
+     @param content_seed Seed of the content
+     @param size Size of the content in bytes
+     @param trap_mask Value xor'ed into the byte at 3/8 of the file, between the blocks read by the partial hash, to make
+                      a file of the same size and nearly the same content. 0 leaves the content unchanged
+     @return Content bytes
+    """
+    content = bytearray(random.Random(content_seed).randbytes(size))
+    content[size * 3 // 8] ^= trap_mask
+    return bytes(content)
+
+
+def get_dir_paths(tree_path, depth, fan_out):
+    """
+     @brief Create the directories of a tree where every directory above depth has fan_out sub directories.
+     @param tree_path Root of the tree
+     @param depth Number of directory levels below the root
+     @param fan_out Number of sub directories of each directory
+     @return List of every directory path, the root included
+    """
+    dir_paths, level_paths = [tree_path], [tree_path]
+    for level in range(depth):
+        level_paths = [os.path.join(dir_path, f"d{level}_{index}") for dir_path in level_paths for index in range(fan_out)]
+        dir_paths.extend(level_paths)
+    for dir_path in dir_paths:
+        os.makedirs(dir_path, exist_ok=True)
+    return dir_paths
+
+
+def build_tree(tree_path, file_count, size_distribution, max_size, duplicate_ratio, trap_ratio, depth, fan_out, seed):
+    """
+     @brief Write a synthetic tree. Each file is a duplicate of an earlier file with probability duplicate_ratio, a trap
+            with probability trap_ratio and unique otherwise. A trap has the size of an earlier file and its content with
+            one byte changed between the blocks read by the partial hash, so only the full hash tells them apart
+     @param tree_path Root of the tree, replaced if it exists
+     @param file_count Number of files
+     @param size_distribution Distribution of the file sizes, see get_file_size
+     @param max_size Largest file size
+     @param duplicate_ratio Share of the files that are duplicates
+     @param trap_ratio Share of the files that have the size but not the content of another file
+     @param depth Number of directory levels
+     @param fan_out Number of sub directories of each directory
+     @param seed Seed of the tree, the same seed always writes the same tree
+     @return Dictionary describing the tree, with the number of duplicates a correct run finds
+    """
+    shutil.rmtree(tree_path, ignore_errors=True)
+    rng = random.Random(seed)
+    dir_paths = get_dir_paths(tree_path, depth, fan_out)
+    # Every (content seed, size, trap mask) written once, a file of the list is written again only as a duplicate
+    originals, original_set = list(), set()
+    duplicate_count, trap_count, total_size = 0, 0, 0
+    for index in range(file_count):
+        draw = rng.random()
+        original = None
+        if originals and draw < duplicate_ratio:
+            original = rng.choice(originals)
+            duplicate_count += 1
+        elif originals and draw < duplicate_ratio + trap_ratio:
+            content_seed, size, trap_mask = rng.choice(originals)
+            trap = (content_seed, size, rng.randint(1, 255))
+            if trap not in original_set:
+                original = trap
+                trap_count += 1
+        if original is None:
+            original = (rng.getrandbits(64), get_file_size(rng, size_distribution, max_size), 0)
+        if original not in original_set:
+            originals.append(original)
+            original_set.add(original)
+        with open(os.path.join(rng.choice(dir_paths), f"f{index}.{FILE_EXTENSION}"), "wb") as file:
+            file.write(get_content(*original))
+        total_size += original[1]
+    return {"file_count": file_count, "total_size": total_size, "dir_count": len(dir_paths), "expected_duplicates": duplicate_count,
+            "trap_count": trap_count}
+
+
+def get_io_counters():
+    """
+     @brief Read the I/O counters of this process and its reaped children, on Linux.
+     @return Dictionary with syscr, syscw, rchar, wchar, read_bytes and write_bytes, empty where /proc/self/io is missing
+    """
+    try:
+        with open("/proc/self/io") as io_file:
+            return {name: int(value) for name, value in (line.split(": ") for line in io_file.read().splitlines())}
+    except OSError:
+        return dict()
+
+
+def run_one(tree_path, settings):
+    """
+     @brief Run one planning pass of the FileManager on a tree and measure it. Runs in its own process
+     @param tree_path Root of the tree
+     @param settings Dictionary of config values for this run, "CACHE" "warm" runs a first pass to fill the file index
+     @return Dictionary of the measurements
+    """
+    import resource
+    sys.path.insert(0, PACKAGE_DIR)
+    from config import Config
+    from shared_data import SharedData
+    from file_manager import FileManager, init_logging
+
+    work_path = tempfile.mkdtemp(prefix="benchmark-run-")
+    is_warm = settings.pop("CACHE", "cold") == "warm"
+    config_values = {"BASE_PATH": [tree_path.rstrip("/") + "/"], "DEST_PATH": os.path.join(work_path, "dest") + "/", "FILE_EXTENSIONS": [FILE_EXTENSION],
+                     "IS_CACHE_READABLE": is_warm, "IS_CACHE_WRITABLE": is_warm, "PRUNE_CACHE": False, "RUN_MODE": "plan",
+                     "PLAN_PATH": os.path.join(work_path, "plan.jsonl"), "LOG_LEVEL": "WARNING", "PROGRESS_SECONDS": 0, "STATS_SECONDS": 0}
+    config_values.update(settings)
+    os.makedirs(os.path.join(work_path, "configs"))
+    with open(os.path.join(work_path, "configs", "config.json"), "w") as config_file:
+        json.dump(config_values, config_file)
+    os.chdir(work_path)
+    config = Config()
+    config.set_root_dir(work_path + "/")
+    config.set_os_name(sys.platform)
+    init_logging(config)
+    if is_warm:
+        FileManager(SharedData(config), config).plan()
+
+    io_counters = get_io_counters()
+    start_time = time.perf_counter()
+    file_manager = FileManager(SharedData(config), config)
+    file_manager.plan()
+    elapsed_seconds = time.perf_counter() - start_time
+    io_counters = {name: value - io_counters.get(name, 0) for name, value in get_io_counters().items()}
+
+    with open(config_values["PLAN_PATH"]) as plan_file:
+        planned_duplicates = sum(len(json.loads(line)["duplicates"]) for line in plan_file)
+    stats = file_manager._metrics.get_stats()
+    shutil.rmtree(work_path, ignore_errors=True)
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    rss_unit = 1 if sys.platform == "darwin" else 1024
+    return {"elapsed_seconds": elapsed_seconds,
+            "files_per_second": stats["counters"].get("scanned_files", 0) / elapsed_seconds,
+            "scanned_bytes_per_second": stats["counters"].get("scanned_bytes", 0) / elapsed_seconds,
+            "hashed_bytes_per_second": stats["counters"].get("hashed_bytes", 0) / elapsed_seconds,
+            "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * rss_unit,
+            "peak_worker_rss_bytes": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * rss_unit,
+            "io": io_counters, "hash_algorithm": file_manager._hasher.algorithm, "planned_duplicates": planned_duplicates,
+            "stage_seconds": stats["stage_seconds"], "counters": stats["counters"]}
+
+
+def get_sweep(args):
+    """
+     @brief Get every combination of the swept settings.
+     @param args Parsed command line arguments
+     @return List of config dictionaries
+    """
+    sweep = list()
+    for workers, buff_size, algorithm, executor, cache in itertools.product(args.workers.split(","), args.buffer_sizes.split(","), args.hash_algorithms.split(","),
+                                                                            args.executors.split(","), args.cache.split(",")):
+        sweep.append({"HASH_WORKERS": int(workers), "BUFF_SIZE": int(buff_size), "MAX_BUFF_SIZE": int(buff_size), "HASH_ALGORITHM": algorithm,
+                      "HASH_EXECUTOR": executor, "CACHE": cache})
+    return sweep
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the FileManager pipeline on synthetic trees")
+    parser.add_argument("--work-dir", help="Directory of the generated tree, a temporary directory by default")
+    parser.add_argument("--keep-tree", action="store_true", help="Keep the generated tree after the benchmark")
+    parser.add_argument("--files", type=int, default=5000, help="Number of files")
+    parser.add_argument("--size-distribution", default="lognormal:65536:1.5", help="lognormal:MEDIAN:SIGMA or uniform:MIN:MAX, in bytes")
+    parser.add_argument("--max-size", type=int, default=64 * 1024 * 1024, help="Largest file size in bytes")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.3, help="Share of the files that are duplicates")
+    parser.add_argument("--trap-ratio", type=float, default=0.05, help="Share of the files with the size but not the content of another file")
+    parser.add_argument("--depth", type=int, default=3, help="Number of directory levels")
+    parser.add_argument("--fan-out", type=int, default=4, help="Number of sub directories of each directory")
+    parser.add_argument("--seed", type=int, default=1, help="Seed of the tree")
+    parser.add_argument("--workers", default="1,4", help="Comma separated HASH_WORKERS values")
+    parser.add_argument("--buffer-sizes", default="65536,1048576", help="Comma separated read buffer sizes")
+    parser.add_argument("--hash-algorithms", default="blake2b,md5", help="Comma separated HASH_ALGORITHM values")
+    parser.add_argument("--executors", default="process", help="Comma separated HASH_EXECUTOR values")
+    parser.add_argument("--cache", default="cold", help="Comma separated file index states, cold or warm")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs of each combination")
+    parser.add_argument("--output", help="JSON Lines file the results are appended to, the standard output by default")
+    parser.add_argument("--run-one", nargs=2, metavar=("TREE", "SETTINGS"), help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.run_one:
+        print(json.dumps(run_one(args.run_one[0], json.loads(args.run_one[1]))))
+        return
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="benchmark-tree-")
+    tree_path = os.path.join(work_dir, "tree")
+    tree = build_tree(tree_path, args.files, args.size_distribution, args.max_size, args.duplicate_ratio, args.trap_ratio, args.depth, args.fan_out, args.seed)
+    tree.update({"size_distribution": args.size_distribution, "duplicate_ratio": args.duplicate_ratio, "trap_ratio": args.trap_ratio,
+                 "depth": args.depth, "fan_out": args.fan_out, "seed": args.seed})
+    print(f"Built {tree['file_count']} files of {tree['total_size']} bytes in {tree_path}", file=sys.stderr)
+    output = open(args.output, "a") if args.output else sys.stdout
+    try:
+        for settings in get_sweep(args):
+            for repeat in range(args.repeat):
+                process = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-one", tree_path, json.dumps(settings)],
+                                         capture_output=True, text=True)
+                if process.returncode != 0:
+                    print(f"Run {settings} failed:\n{process.stderr}", file=sys.stderr)
+                    continue
+                result = json.loads(process.stdout.splitlines()[-1])
+                result.update({"settings": settings, "repeat": repeat, "tree": tree, "python": sys.version.split()[0],
+                               "is_correct": result["planned_duplicates"] == tree["expected_duplicates"]})
+                output.write(json.dumps(result) + "\n")
+                output.flush()
+    finally:
+        if args.output:
+            output.close()
+        if not args.keep_tree and not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+from unittest import mock
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PACKAGE_DIR)
+
+import action_executor
+from action_executor import ActionExecutor
+
+
+class StubConfig(dict):
+    def get(self, param, default=None):
+        value = dict.get(self, param)
+        return default if value is None else value
+
+
+def write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as file:
+        file.write(content)
+
+
+def read_file(path):
+    with open(path, "rb") as file:
+        return file.read()
+
+
+class ActionExecutorTest(unittest.TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.executor = ActionExecutor(StubConfig(USE_PRIVILEGED_HELPER=False))
+
+    def tearDown(self):
+        self.executor.close()
+        shutil.rmtree(self.dir_path, ignore_errors=True)
+
+    def get_path(self, *names):
+        return os.path.join(self.dir_path, *names)
+
+    def test_remove(self):
+        write_file(self.get_path("a.jpg"), b"a")
+        self.executor.remove(self.get_path("a.jpg"))
+        self.assertFalse(os.path.lexists(self.get_path("a.jpg")))
+
+    def test_remove_missing_file_raises(self):
+        with self.assertRaises(FileNotFoundError):
+            self.executor.remove(self.get_path("missing.jpg"))
+
+    def test_move_renames_on_collision(self):
+        write_file(self.get_path("dest", "a.jpg"), b"kept")
+        write_file(self.get_path("dest", "a (1).jpg"), b"kept too")
+        write_file(self.get_path("src", "a.jpg"), b"moved")
+        dest_path = self.executor.move(self.get_path("src", "a.jpg"), self.get_path("dest", "a.jpg"))
+        self.assertEqual(dest_path, self.get_path("dest", "a (2).jpg"))
+        self.assertEqual(read_file(dest_path), b"moved")
+        self.assertEqual(read_file(self.get_path("dest", "a.jpg")), b"kept")
+        self.assertFalse(os.path.lexists(self.get_path("src", "a.jpg")))
+
+    def test_move_across_devices_copies(self):
+        write_file(self.get_path("src", "a.jpg"), b"moved")
+        os.makedirs(self.get_path("dest"))
+        with mock.patch.object(self.executor, "_is_cross_device", return_value=True), \
+                mock.patch.object(action_executor.shutil, "move", wraps=shutil.move) as shutil_move:
+            dest_path = self.executor.move(self.get_path("src", "a.jpg"), self.get_path("dest", "a.jpg"))
+        shutil_move.assert_called_once_with(self.get_path("src", "a.jpg"), dest_path)
+        self.assertEqual(read_file(dest_path), b"moved")
+        self.assertFalse(os.path.lexists(self.get_path("src", "a.jpg")))
+
+    @unittest.skipUnless(os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK), "needs /dev/shm")
+    def test_move_to_another_device(self):
+        if os.stat("/dev/shm").st_dev == os.stat(self.dir_path).st_dev:
+            self.skipTest("/dev/shm is on the same device as the temporary directory")
+        write_file(self.get_path("a.jpg"), b"moved")
+        dest_dir = tempfile.mkdtemp(dir="/dev/shm")
+        try:
+            dest_path = self.executor.move(self.get_path("a.jpg"), os.path.join(dest_dir, "a.jpg"))
+            self.assertEqual(read_file(dest_path), b"moved")
+            self.assertFalse(os.path.lexists(self.get_path("a.jpg")))
+        finally:
+            shutil.rmtree(dest_dir, ignore_errors=True)
+
+    def test_hardlink_replaces_duplicate(self):
+        write_file(self.get_path("keeper.jpg"), b"same")
+        write_file(self.get_path("duplicate.jpg"), b"same")
+        self.executor.link(self.get_path("duplicate.jpg"), self.get_path("keeper.jpg"), "hardlink")
+        self.assertTrue(os.path.samefile(self.get_path("keeper.jpg"), self.get_path("duplicate.jpg")))
+        self.assertEqual(sorted(os.listdir(self.dir_path)), ["duplicate.jpg", "keeper.jpg"])
+
+    def test_failed_hardlink_keeps_duplicate(self):
+        write_file(self.get_path("duplicate.jpg"), b"same")
+        with self.assertRaises(FileNotFoundError):
+            self.executor.link(self.get_path("duplicate.jpg"), self.get_path("missing.jpg"), "hardlink")
+        self.assertEqual(read_file(self.get_path("duplicate.jpg")), b"same")
+        self.assertEqual(os.listdir(self.dir_path), ["duplicate.jpg"])
+
+    def test_failed_reflink_removes_temporary_file(self):
+        write_file(self.get_path("keeper.jpg"), b"same")
+        write_file(self.get_path("duplicate.jpg"), b"same")
+
+        def fail_after_creating_clone(keeper_path, temp_path):
+            write_file(temp_path, b"")
+            raise OSError("clone failed")
+
+        with mock.patch.object(self.executor, "_reflink", side_effect=fail_after_creating_clone):
+            with self.assertRaises(OSError):
+                self.executor.link(self.get_path("duplicate.jpg"), self.get_path("keeper.jpg"), "reflink")
+        self.assertEqual(sorted(os.listdir(self.dir_path)), ["duplicate.jpg", "keeper.jpg"])
+        self.assertFalse(os.path.samefile(self.get_path("keeper.jpg"), self.get_path("duplicate.jpg")))
+
+
+class PrivilegedHelperTest(unittest.TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.dir_path, "a.jpg")
+        write_file(self.file_path, b"a")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path, ignore_errors=True)
+
+    def test_permission_error_is_raised_without_helper(self):
+        executor = ActionExecutor(StubConfig(USE_PRIVILEGED_HELPER=False))
+        with mock.patch.object(action_executor.os, "remove", side_effect=PermissionError("denied")):
+            with self.assertRaises(PermissionError):
+                executor.remove(self.file_path)
+        self.assertTrue(os.path.exists(self.file_path))
+
+    @unittest.skipIf(os.name == "nt", "the helper is not used on Windows")
+    def test_permission_error_goes_through_helper(self):
+        # The helper runs without sudo here, the in-process removal is the one denied
+        started_commands, popen = list(), subprocess.Popen
+
+        def start_without_sudo(command, **kwargs):
+            started_commands.append(command)
+            return popen(command[1:], **kwargs)
+
+        executor = ActionExecutor(StubConfig(USE_PRIVILEGED_HELPER=True))
+        with mock.patch.object(action_executor.os, "remove", side_effect=PermissionError("denied")), \
+                mock.patch.object(action_executor.os, "geteuid", return_value=1000), \
+                mock.patch.object(action_executor.subprocess, "Popen", side_effect=start_without_sudo):
+            executor.remove(self.file_path)
+            with self.assertRaises(OSError):
+                executor.remove(self.file_path)
+        executor.close()
+        self.assertEqual(len(started_commands), 1)
+        self.assertEqual(started_commands[0][0], "sudo")
+        self.assertFalse(os.path.lexists(self.file_path))
+
+    @unittest.skipIf(os.name == "nt", "the helper is not used on Windows")
+    def test_permission_error_is_raised_when_sudo_is_missing(self):
+        executor = ActionExecutor(StubConfig(USE_PRIVILEGED_HELPER=True))
+        with mock.patch.object(action_executor.os, "remove", side_effect=PermissionError("denied")), \
+                mock.patch.object(action_executor.os, "geteuid", return_value=1000), \
+                mock.patch.object(action_executor.subprocess, "Popen", side_effect=FileNotFoundError("sudo")):
+            with self.assertRaises(PermissionError):
+                executor.remove(self.file_path)
+        self.assertTrue(os.path.exists(self.file_path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PACKAGE_DIR)
+
+from file_verifier import FileVerifier
+
+
+class FileVerifierTest(unittest.TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        # A small chunk size makes the files span several chunks
+        self.verifier = FileVerifier(4096, 2)
+        self.content = os.urandom(4096 * 3 + 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path, ignore_errors=True)
+
+    def write_file(self, name, content):
+        path = os.path.join(self.dir_path, name)
+        with open(path, "wb") as file:
+            file.write(content)
+        return path
+
+    def test_identical_files(self):
+        self.assertTrue(self.verifier.is_identical(self.write_file("keeper", self.content), self.write_file("copy", self.content)))
+
+    def test_empty_files(self):
+        self.assertTrue(self.verifier.is_identical(self.write_file("keeper", b""), self.write_file("copy", b"")))
+
+    def test_last_byte_differs(self):
+        changed_content = self.content[:-1] + bytes([self.content[-1] ^ 1])
+        self.assertFalse(self.verifier.is_identical(self.write_file("keeper", self.content), self.write_file("copy", changed_content)))
+
+    def test_different_sizes(self):
+        self.assertFalse(self.verifier.is_identical(self.write_file("keeper", self.content), self.write_file("copy", self.content + b"x")))
+
+    def test_hardlink_is_identical(self):
+        keeper_path = self.write_file("keeper", self.content)
+        os.link(keeper_path, os.path.join(self.dir_path, "link"))
+        self.assertTrue(self.verifier.is_identical(keeper_path, os.path.join(self.dir_path, "link")))
+
+    def test_missing_file_is_not_identical(self):
+        self.assertFalse(self.verifier.is_identical(self.write_file("keeper", self.content), os.path.join(self.dir_path, "missing")))
+
+    def test_verify_pairs(self):
+        keeper_path = self.write_file("keeper", self.content)
+        copy_path = self.write_file("copy", self.content)
+        changed_path = self.write_file("changed", self.content[:100] + b"x" + self.content[101:])
+        self.assertEqual(self.verifier.verify_pairs([(keeper_path, copy_path), (keeper_path, changed_path)]), {copy_path})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Sharded scanning end to end on one machine: each node is a directory with its own config and tree, its shard is
+# written by a separate file_manager.py process, the shards are merged by shard_merger.py and each node applies its plan.
+
+
+def write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as file:
+        file.write(content)
+
+
+def read_plan(plan_path):
+    with open(plan_path, encoding="utf-8") as plan_file:
+        return [json.loads(line) for line in plan_file if line.strip()]
+
+
+class ShardedScanTest(unittest.TestCase):
+    def setUp(self):
+        self.dir_path = tempfile.mkdtemp()
+        self.shard_dir = os.path.join(self.dir_path, "shards")
+        self.plan_dir = os.path.join(self.dir_path, "plans") + "/"
+
+    def tearDown(self):
+        shutil.rmtree(self.dir_path, ignore_errors=True)
+
+    def get_tree_path(self, node_name, *names):
+        return os.path.join(self.dir_path, node_name, "tree", *names)
+
+    def write_config(self, work_dir, config_values):
+        # ROOT_DIR keeps the logs and the file index of each process in its work directory
+        config = {"ROOT_DIR": work_dir, "BUFF_SIZE": 65536, "FILE_EXTENSIONS": ["jpg"], "IS_CACHE_WRITABLE": False, "IS_CACHE_READABLE": False,
+                  "USE_PRIVILEGED_HELPER": False, "HASH_WORKERS": 2, "PROGRESS_SECONDS": 0, "STATS_SECONDS": 0, "PRUNE_CACHE": False}
+        config.update(config_values)
+        write_file(os.path.join(work_dir, "configs", "config.json"), json.dumps(config).encode("utf-8"))
+
+    def write_node_config(self, node_name, config_values=None):
+        work_dir = os.path.join(self.dir_path, node_name)
+        self.write_config(work_dir, {"BASE_PATH": [self.get_tree_path(node_name) + "/"], "DEST_PATH": os.path.join(work_dir, "dest") + "/",
+                                     "NODE_NAME": node_name, "SHARD_PATH": os.path.join(self.shard_dir, f"{node_name}.shard.gz"),
+                                     "PLAN_PATH": f"{self.plan_dir}{node_name}.jsonl", "SHARD_RUN_ROWS": 2, **(config_values or {})})
+        return work_dir
+
+    def run_file_manager(self, work_dir, *args):
+        return subprocess.Popen([sys.executable, os.path.join(PACKAGE_DIR, "file_manager.py")] + list(args), cwd=work_dir,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+
+    def apply_plan(self, work_dir):
+        apply_process = self.run_file_manager(work_dir, "apply")
+        output = apply_process.communicate()[0]
+        self.assertEqual(apply_process.returncode, 0, output)
+
+    def get_remaining_paths(self):
+        return sorted(os.path.relpath(os.path.join(dir_path, name), self.dir_path)
+                      for dir_path, dir_names, file_names in os.walk(self.dir_path) if "/tree" in dir_path for name in file_names)
+
+    def test_shard_merge_apply(self):
+        shared_content, node_content, node_a_content = os.urandom(20000), os.urandom(7000), os.urandom(5000)
+        # node-a holds the keeper of a group node-b has a copy of
+        write_file(self.get_tree_path("node-a", "a.jpg"), shared_content)
+        write_file(self.get_tree_path("node-a", "unique.jpg"), node_a_content)
+        write_file(self.get_tree_path("node-b", "b.jpg"), shared_content)
+        # node-b also has a group of its own, with a path already hardlinked to its keeper
+        write_file(self.get_tree_path("node-b", "local", "1.jpg"), node_content)
+        write_file(self.get_tree_path("node-b", "local", "2.jpg"), node_content)
+        os.link(self.get_tree_path("node-b", "local", "1.jpg"), self.get_tree_path("node-b", "local", "3.jpg"))
+        write_file(self.get_tree_path("node-b", "unique.jpg"), os.urandom(5000))
+        work_dirs = {node_name: self.write_node_config(node_name) for node_name in ("node-a", "node-b")}
+
+        shard_processes = [self.run_file_manager(work_dir, "shard") for work_dir in work_dirs.values()]
+        for shard_process in shard_processes:
+            output = shard_process.communicate()[0]
+            self.assertEqual(shard_process.returncode, 0, output)
+
+        merge_dir = os.path.join(self.dir_path, "merge")
+        self.write_config(merge_dir, {"SHARD_PLAN_DIR": self.plan_dir})
+        shard_paths = [os.path.join(self.shard_dir, f"{node_name}.shard.gz") for node_name in work_dirs]
+        merge = subprocess.run([sys.executable, os.path.join(PACKAGE_DIR, "shard_merger.py")] + shard_paths, cwd=merge_dir,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        self.assertEqual(merge.returncode, 0, merge.stdout)
+
+        self.assertEqual(read_plan(f"{self.plan_dir}node-a.jsonl"), [])
+        groups = {group["size"]: group for group in read_plan(f"{self.plan_dir}node-b.jsonl")}
+        self.assertEqual(sorted(groups), [len(node_content), len(shared_content)])
+        remote_group, local_group = groups[len(shared_content)], groups[len(node_content)]
+        self.assertEqual((remote_group["keeper_node"], remote_group["keeper"][0]), ("node-a", self.get_tree_path("node-a", "a.jpg")))
+        self.assertEqual([path for path, file_key in remote_group["duplicates"]], [self.get_tree_path("node-b", "b.jpg")])
+        self.assertEqual((local_group["keeper_node"], local_group["keeper"][0]), ("node-b", self.get_tree_path("node-b", "local", "1.jpg")))
+        self.assertEqual([path for path, file_key in local_group["duplicates"]], [self.get_tree_path("node-b", "local", "2.jpg")])
+
+        # The keeper on node-a can't be checked from node-b, so its duplicate is kept until TRUST_REMOTE_KEEPERS is set
+        for work_dir in work_dirs.values():
+            self.apply_plan(work_dir)
+        self.assertEqual(self.get_remaining_paths(), ["node-a/tree/a.jpg", "node-a/tree/unique.jpg", "node-b/tree/b.jpg",
+                                                      "node-b/tree/local/1.jpg", "node-b/tree/local/3.jpg", "node-b/tree/unique.jpg"])
+        self.write_node_config("node-b", {"TRUST_REMOTE_KEEPERS": True})
+        self.apply_plan(work_dirs["node-b"])
+        self.assertEqual(self.get_remaining_paths(), ["node-a/tree/a.jpg", "node-a/tree/unique.jpg", "node-b/tree/local/1.jpg",
+                                                      "node-b/tree/local/3.jpg", "node-b/tree/unique.jpg"])
+        with open(os.path.join(work_dirs["node-b"], "log", "removed.txt"), encoding="utf-8") as log_file:
+            self.assertEqual(len(log_file.readlines()), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()